@@ -0,0 +1,158 @@
+'''
+This code is to check mixed precision and channels-last training against float32 by comparing loss curves on CPU,
+for the default per-step decoder and the weight-shared decoder.
+'''
+import argparse
+import copy
+import sys
+import torch
+import torch.optim as optim
+import torch.nn.functional as F
+# internal package
+from dataset.dataset import dictionary_generator
+from models.sar import sar
+from utils.precision import autocast, channels_last
+from utils.dataproc import compact_tokens
+
+def loss_curve(model, x, y, steps, amp, memory_format, seed):
+    '''
+    model: sar model in train mode
+    x: input images [batch, channel, height, width]
+    y: label indices [batch, seq_len]
+    steps: number of training steps on the batch
+    amp: train under autocast
+    memory_format: memory format of the input images
+    seed: random seed, the same seed gives the same dropout masks for every run
+    Output: list of losses
+    '''
+    device = torch.device("cpu")
+    torch.manual_seed(seed)
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    x = x.to(memory_format=memory_format)
+    losses = []
+    for step in range(steps):
+        optimizer.zero_grad()
+        with autocast(device, amp):
+            predict, _, _, _ = model(x, y)
+        loss = F.nll_loss(predict.float().permute(0,2,1), y)
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return losses
+
+def eval_decode(model, x, y, amp, memory_format, beam_width):
+    '''
+    model: trained sar model
+    x: input images [batch, channel, height, width]
+    y: label indices [batch, seq_len], only their shape is used in eval mode
+    amp: decode under autocast
+    memory_format: memory format of the input images
+    beam_width: 1 for greedy search, otherwise beam search
+    Output: predicted label indices [batch, seq_len]
+    '''
+    device = torch.device("cpu")
+    model.eval()
+    model.decoder_model.beam_width = beam_width
+    with torch.no_grad(), autocast(device, amp):
+        predict, _, _, _ = model(x.to(memory_format=memory_format), y, return_attention=True)
+    return predict.argmax(2)
+
+def char_accuracy(index, y, char2id):
+    '''
+    index: predicted label indices [batch, seq_len]
+    y: label indices [batch, seq_len]
+    Output: fraction of the label characters decoded at their position, after cutting both at END and dropping PAD
+    '''
+    predict_ids, _ = compact_tokens(index.numpy(), char2id)
+    target_ids, _ = compact_tokens(y.numpy(), char2id)
+    valid = target_ids >= 0
+    return float((predict_ids == target_ids)[valid].mean())
+
+def window_mean(losses, start, window):
+    return sum(losses[start:start+window]) / len(losses[start:start+window])
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=300, help='training steps per run')
+    parser.add_argument('--batch', type=int, default=8, help='batch size')
+    parser.add_argument('--width', type=int, default=64, help='input width')
+    parser.add_argument('--window', type=int, default=50, help='steps averaged for every compared loss value')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed difference of the averaged losses, relative to the initial fp32 loss')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--beam', type=int, default=3, help='beam width of the eval beam search pass')
+    parser.add_argument('--eval_tolerance', type=float, default=0.1, help='allowed difference of the eval character accuracy to fp32')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    Height = 48
+    Width = opt.width
+    feature_height = Height // 4
+    feature_width = Width // 8
+    Channel = 3
+    voc, char2id, id2char = dictionary_generator()
+    output_classes = len(voc)
+    embedding_dim = 512
+    hidden_units = 512
+    layers = 2
+    keep_prob = 1.0
+    seq_len = 40
+
+    torch.manual_seed(opt.seed)
+    x = torch.rand(opt.batch, Channel, Height, Width) * 2 - 1
+    y = torch.full((opt.batch, seq_len), char2id['PAD'], dtype=torch.long)
+    lengths = torch.randint(3, 10, (opt.batch,))
+    for i in range(opt.batch):
+        y[i,:lengths[i]] = torch.randint(0, char2id['END'], (int(lengths[i]),))
+    y[:,-1] = char2id['END']
+
+    settings = {
+        'fp32': (False, torch.contiguous_format),
+        'amp': (True, torch.contiguous_format),
+        'channels_last': (False, torch.channels_last),
+        'amp+channels_last': (True, torch.channels_last),
+    }
+    passed = True
+    # the default decoder with one LSTM cell per time step, as trained by train.py, and the weight-shared one
+    for share_weights in (False, True):
+        print("share_weights={}".format(share_weights))
+        torch.manual_seed(opt.seed)
+        model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, share_weights=share_weights).train()
+        runs = {}
+        trained = {}
+        for name, (amp, memory_format) in settings.items():
+            trained[name] = copy.deepcopy(model)
+            if memory_format == torch.channels_last:
+                trained[name] = channels_last(trained[name])
+            runs[name] = loss_curve(trained[name], x, y, opt.steps, amp, memory_format, opt.seed)
+
+        reference = runs['fp32']
+        print("{:>8} ".format('step') + ' '.join("{:>18}".format(name) for name in runs))
+        for start in range(0, opt.steps, opt.window):
+            print("{:>8} ".format(start) + ' '.join("{:>18.4f}".format(window_mean(losses, start, opt.window)) for losses in runs.values()))
+        for name, losses in runs.items():
+            if name == 'fp32':
+                continue
+            # differences are relative to the initial loss, the loss of an overfitted batch goes to 0
+            differences = [abs(window_mean(losses, start, opt.window) - window_mean(reference, start, opt.window)) / window_mean(reference, 0, opt.window)
+                           for start in range(0, opt.steps, opt.window)]
+            ok = max(differences) <= opt.tolerance and losses[-1] < losses[0]
+            passed = passed and ok
+            print("{}: max relative difference to fp32 {:.4f} - {}".format(name, max(differences), 'PASS' if ok else 'FAIL'))
+
+        # eval decoding writes the half precision step outputs of autocast into float32 buffers
+        for beam_width in (1, opt.beam):
+            search = 'greedy' if beam_width == 1 else 'beam {}'.format(beam_width)
+            accuracies = {name: char_accuracy(eval_decode(trained[name], x, y, amp, memory_format, beam_width), y, char2id)
+                          for name, (amp, memory_format) in settings.items()}
+            print("fp32: eval {} character accuracy {:.4f}".format(search, accuracies['fp32']))
+            for name, accuracy in accuracies.items():
+                if name == 'fp32':
+                    continue
+                difference = abs(accuracy - accuracies['fp32'])
+                ok = difference <= opt.eval_tolerance
+                passed = passed and ok
+                print("{}: eval {} character accuracy {:.4f}, difference to fp32 {:.4f} - {}".format(name, search, accuracy, difference, 'PASS' if ok else 'FAIL'))
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,176 @@
+'''
+This code is to benchmark the throughput and latency of the SAR components and the integrated model.
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import torch
+# internal package
+from dataset.dataset import dictionary_generator
+from models.mobilenetv2 import MobileNetV2
+from models.backbone import backbone
+from models.shufflenetv2 import shufflenet_v2_x1_0
+from models.encoder import encoder
+from models.decoder import decoder
+from models.sar import sar
+
+COMPONENTS = ['mobilenetv2', 'backbone', 'shufflenet', 'encoder', 'decoder_teacher', 'decoder_greedy', 'sar']
+
+def build_components(names, height, hidden_units, seq_len, output_classes, device, share_weights, compact=False, stop_on_pad=False):
+    '''
+    names: component names from COMPONENTS
+    Output: dict of name -> (model, input function of (batch, width) returning the forward arguments)
+    The decoder runs teacher-forced in train mode and greedy in eval mode, both without gradients.
+    compact and stop_on_pad are the early exit options of the greedy decoder.
+    '''
+    feature_height = height // 4
+    D = 512 # feature depth of the backbones
+    image = lambda batch, width: (torch.rand(batch, 3, height, width).to(device) * 2 - 1,)
+    feature = lambda batch, width: (torch.randn(batch, D, feature_height, width // 8).to(device),)
+    label = lambda batch: torch.randint(0, output_classes, (batch, seq_len)).to(device)
+    decoder_inputs = lambda batch, width: (torch.randn(batch, hidden_units).to(device), label(batch), feature(batch, width)[0])
+    components = {}
+    for name in names:
+        if name == 'mobilenetv2':
+            components[name] = (MobileNetV2().eval(), image)
+        elif name == 'backbone':
+            components[name] = (backbone(3).eval(), image)
+        elif name == 'shufflenet':
+            components[name] = (shufflenet_v2_x1_0().eval(), image)
+        elif name == 'encoder':
+            components[name] = (encoder(feature_height, D, hidden_units, device=device).eval(), feature)
+        elif name == 'decoder_teacher':
+            components[name] = (decoder(output_classes, feature_height, 1, D, hidden_units, seq_len, device, share_weights=share_weights).train(), decoder_inputs)
+        elif name == 'decoder_greedy':
+            components[name] = (decoder(output_classes, feature_height, 1, D, hidden_units, seq_len, device, share_weights=share_weights, compact=compact, stop_on_pad=stop_on_pad).eval(), decoder_inputs)
+        elif name == 'sar':
+            model = sar(3, feature_height, 1, 512, output_classes, hidden_units, seq_len=seq_len, device=device, share_weights=share_weights, compact=compact, stop_on_pad=stop_on_pad).eval()
+            components[name] = (model, lambda batch, width: (image(batch, width)[0], label(batch)))
+        else:
+            raise ValueError("unknown component {}, choose from {}".format(name, '|'.join(COMPONENTS)))
+    return {name: (model.to(device), inputs) for name, (model, inputs) in components.items()}
+
+def measure(model, inputs, warmup, repeat, device):
+    '''
+    model: module to benchmark
+    inputs: forward arguments
+    warmup: untimed calls before measuring
+    repeat: timed calls
+    Output: array of latencies in seconds
+    '''
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            model(*inputs)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies)
+
+def compare(results, baseline, threshold):
+    '''
+    results: list of benchmark records
+    baseline: list of benchmark records of a previous run
+    threshold: allowed relative drop of images/sec
+    Output: list of (record, baseline record) pairs that regressed
+    '''
+    reference = {(r['component'], r['batch'], r['width']): r for r in baseline}
+    regressions = []
+    for record in results:
+        base = reference.get((record['component'], record['batch'], record['width']))
+        if base is None:
+            continue
+        change = record['images_per_sec'] / base['images_per_sec'] - 1.0
+        print("{:>16} batch {:>4} width {:>4}: {:>10.1f} -> {:>10.1f} images/sec ({:+.1%})".format(
+            record['component'], record['batch'], record['width'], base['images_per_sec'], record['images_per_sec'], change))
+        if change < -threshold:
+            regressions.append((record, base))
+    return regressions
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--components', type=str, default=','.join(COMPONENTS), help="comma separated components - " + '|'.join(COMPONENTS))
+    parser.add_argument('--batch', type=str, default='1,8,32', help='comma separated batch sizes')
+    parser.add_argument('--width', type=str, default='64,160', help='comma separated input widths, multiples of 8')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed calls before measuring')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per configuration')
+    parser.add_argument('--threads', type=int, default=0, help='number of CPU threads, 0 for the torch default')
+    parser.add_argument('--gpu', type=bool, default=False, help="GPU being used or not")
+    parser.add_argument('--share_weights', action='store_true', help="share the decoder LSTM cells across time steps")
+    parser.add_argument('--stop_on_pad', action='store_true', help="also stop decoding a sequence at PAD, for models trained on targets with PAD after the word")
+    parser.add_argument('--compact', action='store_true', help="drop finished sequences from the decoding batch at every step")
+    parser.add_argument('--output', type=str, default='', help='json file to write the results to')
+    parser.add_argument('--baseline', type=str, default='', help='json file of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative images/sec drop reported as a regression')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if torch.cuda.is_available() == True and opt.gpu == True:
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    Height = 48
+    voc, char2id, id2char = dictionary_generator()
+    output_classes = len(voc)
+    hidden_units = 512
+    seq_len = 40
+    batch_sizes = [int(b) for b in opt.batch.split(',')]
+    widths = [int(w) for w in opt.width.split(',')]
+
+    torch.manual_seed(0)
+    components = build_components(opt.components.split(','), Height, hidden_units, seq_len, output_classes, device, opt.share_weights, opt.compact, opt.stop_on_pad)
+
+    results = []
+    for name, (model, inputs) in components.items():
+        for width in widths:
+            for batch_size in batch_sizes:
+                latencies = measure(model, inputs(batch_size, width), opt.warmup, opt.repeat, device)
+                record = {
+                    'component': name,
+                    'batch': batch_size,
+                    'width': width,
+                    'mean': float(latencies.mean()),
+                    'p50': float(np.percentile(latencies, 50)),
+                    'p95': float(np.percentile(latencies, 95)),
+                    'p99': float(np.percentile(latencies, 99)),
+                    'images_per_sec': float(batch_size / latencies.mean()),
+                }
+                results.append(record)
+                print("{:>16} batch {:>4} width {:>4}: {:>10.1f} images/sec p50 {:.4f}s p95 {:.4f}s p99 {:.4f}s".format(
+                    name, batch_size, width, record['images_per_sec'], record['p50'], record['p95'], record['p99']))
+
+    if opt.output != '':
+        config = {
+            'device': device.type,
+            'threads': torch.get_num_threads(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'warmup': opt.warmup,
+            'repeat': opt.repeat,
+            'share_weights': opt.share_weights,
+            'compact': opt.compact,
+            'stop_on_pad': opt.stop_on_pad,
+        }
+        with open(opt.output, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+
+    if opt.baseline != '':
+        with open(opt.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, opt.threshold)
+        if len(regressions) > 0:
+            print("{} regression(s) beyond {:.0%}!".format(len(regressions), opt.threshold))
+            sys.exit(1)
+        print("No regression beyond {:.0%}".format(opt.threshold))
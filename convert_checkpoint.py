@@ -0,0 +1,71 @@
+'''
+This code is to convert a trained SAR checkpoint into the weight-shared decoder and report its cost.
+'''
+import os
+import argparse
+import time
+import torch
+# internal package
+from dataset.dataset import dictionary_generator
+from models.sar import sar
+from utils.checkpoint import share_lstm_weights
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+def batch_latency(model, x, repeat):
+    '''
+    model: sar model in eval mode
+    x: input images [batch, channel, height, width]
+    repeat: number of timed forward passes after one warm-up pass
+    Output: average seconds per batch
+    '''
+    with torch.no_grad():
+        model(x, 0)
+        start_time = time.time()
+        for _ in range(repeat):
+            model(x, 0)
+    return (time.time() - start_time) / repeat
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='input model path, e.g. model_best.pth')
+    parser.add_argument('--output', type=str, required=True, help='output model path for the weight-shared decoder')
+    parser.add_argument('--mode', type=str, default='average', help="conversion mode - average|select")
+    parser.add_argument('--step', type=int, default=1, help="time step whose LSTM cells are kept with --mode select")
+    parser.add_argument('--batch', type=int, default=32, help='batch size for the latency benchmark')
+    parser.add_argument('--width', type=int, default=160, help='input width for the latency benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='timed batches for the latency benchmark, 0 to skip it')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    Height = 48
+    Width = opt.width
+    feature_height = Height // 4
+    feature_width = Width // 8
+    Channel = 3
+    voc, char2id, id2char = dictionary_generator()
+    output_classes = len(voc)
+    embedding_dim = 512
+    hidden_units = 512
+    layers = 2
+    keep_prob = 1.0
+    seq_len = 40
+
+    state_dict = torch.load(opt.model, map_location=lambda storage, loc: storage)
+    shared_dict = share_lstm_weights(state_dict, opt.mode, opt.step)
+    torch.save(shared_dict, opt.output)
+
+    model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len)
+    model.load_state_dict(state_dict)
+    shared_model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, share_weights=True)
+    shared_model.load_state_dict(shared_dict)
+
+    print("Parameters before: {} after: {}".format(count_parameters(model), count_parameters(shared_model)))
+    print("Checkpoint size before: {:.1f} MB after: {:.1f} MB".format(os.path.getsize(opt.model) / 2**20, os.path.getsize(opt.output) / 2**20))
+    if opt.repeat > 0:
+        x = torch.randn(opt.batch, Channel, Height, Width)
+        print("Latency per batch before: {:.4f}s after: {:.4f}s".format(
+            batch_latency(model.eval(), x, opt.repeat), batch_latency(shared_model.eval(), x, opt.repeat)))
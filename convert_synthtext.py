@@ -0,0 +1,27 @@
+'''
+This code is to convert the SynthText gt.mat once into an index that the dataset builder opens memory-mapped.
+'''
+import os
+import time
+import argparse
+# internal package
+from dataset import dataset
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mat', type=str, required=True, help="path of the SynthText gt.mat")
+    parser.add_argument('--output', type=str, default='', help="index folder, default gt_index next to gt.mat where synthtext_dataset_builder looks for it")
+
+    opt = parser.parse_args()
+    print(opt)
+
+    index_path = opt.output if opt.output != '' else dataset.synthtext_index_path(opt.mat)
+    if os.path.exists(index_path):
+        print("Index {} already exists!".format(index_path))
+        exit(1)
+
+    start_time = time.time()
+    dataset.synthtext_index(opt.mat, index_path)
+    size = sum(os.path.getsize(os.path.join(index_path, name)) for name in os.listdir(index_path))
+    print("Index written to {} in {:.1f} s, {:.1f} MB".format(index_path, time.time() - start_time, size / 2**20))
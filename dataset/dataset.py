@@ -8,7 +8,16 @@ import os
 import torch
 import torchvision
 import numpy as np
+import random
+import itertools
+import hashlib
+import json
+import tempfile
+import zipfile
+from collections import OrderedDict
 import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+from PIL import Image
 from scipy.io import loadmat
 import pdb
 
@@ -45,6 +54,30 @@ def end_cut(indices, char2id, id2char):
             break
     return ''.join(cut_indices)
 
+def preprocess_image(IMG, height, width):
+    '''
+    IMG: uint8 image [H, W, C] in BGR order
+    height: input height to model
+    width: input width to model
+    Output: resized uint8 tensor [height, width, C], stacked batches are normalized by normalize_batch
+    '''
+    IMG = cv2.resize(IMG, (width, height)) # resize
+
+    return torch.from_numpy(IMG)
+
+def normalize_batch(x, device, memory_format=torch.contiguous_format):
+    '''
+    x: uint8 images [batch, H, W, C] as returned by the dataset builders
+    device: device to run the model on
+    memory_format: memory format of the output, channels_last needs no copy after the permute
+    Output: float tensor [batch, C, H, W] normalized to [-1,1] on device
+    The batch is copied to the device as uint8, a quarter of the bytes of float32, and converted there.
+    '''
+    x = x.to(device, non_blocking=True).permute(0,3,1,2).float() # [batch, C, H, W]
+    x = x.sub_(127.5).div_(127.5) # normalization to [-1,1]
+
+    return x.contiguous(memory_format=memory_format)
+
 def svt_xml_extractor(label_path):
     '''
     This code is to extract xml labels from SVT dataset
@@ -104,19 +137,14 @@ def iiit5k_mat_extractor(label_path):
 
     return dict_img
 
-def synthtext_mat_extractor(label_path):
+def _synthtext_words(mat_contents):
     '''
-    This code is to extract mat labels from SynthText dataset
+    Iterate over the images of a loaded SynthText gt.mat
     Input:
-    label_path: mat label path file
+    mat_contents: loadmat output with imnames, wordBB and txt, charBB is not needed
     Output:
-    dict_img: [image_name, bounding box, labels]
+    generator of (image_name, list of word bounding boxes (xmin, ymin, xmax, ymax), list of labels)
     '''
-    # create empty list for news items
-    dict_img = []
-
-    mat_contents = loadmat(label_path)
-
     for i in range(len(mat_contents['imnames'][0])):
         image_name = mat_contents['imnames'][0][i][0].split('/')[-1]
         word_bdbs = []
@@ -136,12 +164,6 @@ def synthtext_mat_extractor(label_path):
             ymax = max(word_bdb[1,:])
             word_bdbs.append((int(xmin),int(ymin),int(xmax),int(ymax)))
 
-        if len(mat_contents['charBB'][0][i].shape) == 3:
-            for bdb_idx in range(mat_contents['charBB'][0][i].shape[-1]):
-                char_bdb = mat_contents['charBB'][0][i][:,:,bdb_idx] # shape (2,4), i.e., 4 points for (x,y)
-        else:
-            char_bdb = mat_contents['charBB'][0][i][:,:] # shape (2,4), i.e., 4 points for (x,y)
-
         labels = []
         for label_idx in range(mat_contents['txt'][0][i].shape[0]):
             label_total = mat_contents['txt'][0][i][label_idx]
@@ -154,27 +176,239 @@ def synthtext_mat_extractor(label_path):
         if len(word_bdbs) != len(labels):
             print("Wrong parsing for labels in SynthText dataset!")
             exit(1)
+        yield image_name, word_bdbs, labels
+
+def synthtext_mat_extractor(label_path):
+    '''
+    This code is to extract mat labels from SynthText dataset
+    Input:
+    label_path: mat label path file
+    Output:
+    dict_img: [image_name, bounding box, labels]
+    '''
+    # create empty list for news items
+    dict_img = []
+
+    mat_contents = loadmat(label_path, variable_names=['imnames', 'wordBB', 'txt']) # charBB is not used
+
+    for image_name, word_bdbs, labels in _synthtext_words(mat_contents):
         for word_bdb, label in zip(word_bdbs, labels):
             dict_img.append([image_name, word_bdb, label])
 
     return dict_img
 
+def synthtext_index_path(label_path):
+    '''
+    label_path: mat label path file
+    Output: default folder of its converted index, e.g. gt_index next to gt.mat
+    '''
+    return os.path.splitext(label_path)[0] + '_index'
+
+def synthtext_index(label_path, index_path):
+    '''
+    One-time conversion of the SynthText gt.mat into an index folder read lazily by synthtext_dataset_builder:
+    names.npy: fixed-width bytes array [num_images] of image file names
+    image_index.npy: int32 array [num_words], image of each word
+    boxes.npy: int32 array [num_words, 4] of word bounding boxes (xmin, ymin, xmax, ymax)
+    label_offsets.npy: int64 array [num_words+1], label i is labels[label_offsets[i]:label_offsets[i+1]]
+    labels.npy: uint8 array of the UTF-8 encoded labels
+    Input:
+    label_path: mat label path file
+    index_path: output folder, written to a temporary folder first and renamed when complete
+    '''
+    mat_contents = loadmat(label_path, variable_names=['imnames', 'wordBB', 'txt']) # charBB is not used
+    names = []
+    image_index = []
+    boxes = []
+    labels = []
+    for image_id, (image_name, word_bdbs, words) in enumerate(_synthtext_words(mat_contents)):
+        names.append(image_name.encode('utf-8'))
+        image_index += [image_id] * len(word_bdbs)
+        boxes += word_bdbs
+        labels += [word.encode('utf-8') for word in words]
+    del mat_contents
+    lengths = np.array([len(label) for label in labels], dtype=np.int64)
+    label_offsets = np.zeros(len(labels)+1, dtype=np.int64)
+    np.cumsum(lengths, out=label_offsets[1:])
+
+    tmp_path = index_path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'names.npy'), np.array(names))
+    np.save(os.path.join(tmp_path, 'image_index.npy'), np.array(image_index, dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'boxes.npy'), np.array(boxes, dtype=np.int32).reshape(-1, 4))
+    np.save(os.path.join(tmp_path, 'label_offsets.npy'), label_offsets)
+    np.save(os.path.join(tmp_path, 'labels.npy'), np.frombuffer(b''.join(labels), dtype=np.uint8))
+    os.rename(tmp_path, index_path)
+
+def syn90k_label(img_name):
+    '''
+    img_name: Syn90k file name index_label_lexicon.jpg
+    Output: label string
+    '''
+    _, label, _ = img_name.split('_')
+    return label
+
+def manifest_cache_path():
+    '''
+    Output: folder of the directory manifests, $SAR_CACHE or ~/.cache/sar
+    '''
+    return os.environ.get('SAR_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sar'))
+
+class directory_manifest(object):
+    def __init__(self, path, label_fn=None, cache_path=None):
+        '''
+        Persistent listing of an image folder with the file name, size, mtime, label and image dimensions of
+        every file. It is built on first use and reused as long as the fingerprint of the folder (its own mtime,
+        which changes when files are added, removed or renamed) is unchanged, so a restart costs one stat
+        instead of a listdir of the folder.
+        path: image folder
+        label_fn: optional function of the file name giving its label, e.g. syn90k_label
+        cache_path: folder of the manifests, default manifest_cache_path()
+        '''
+        self.path = path
+        cache_path = manifest_cache_path() if cache_path is None else cache_path
+        stat = os.stat(path)
+        self.key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+        fingerprint = hashlib.sha1('{} {} {}'.format(stat.st_dev, stat.st_ino, stat.st_mtime_ns).encode('utf-8')).hexdigest()[:16]
+        self.manifest_path = os.path.join(cache_path, '{}-{}.npz'.format(self.key, fingerprint))
+        loaded = False
+        if os.path.exists(self.manifest_path):
+            try:
+                with np.load(self.manifest_path) as manifest:
+                    self.names = manifest['names'].tolist()
+                    self.sizes = manifest['sizes']
+                    self.mtimes = manifest['mtimes']
+                    self.dims = manifest['dims'] # [N, 2] width, height of each image, -1 until first requested
+                    self.labels = manifest['labels'].tolist() if 'labels' in manifest.files else None
+                loaded = True
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print("Could not read the manifest of {}, rebuilding it: {}".format(self.path, e))
+        if not loaded:
+            entries = sorted((entry.name, entry.stat()) for entry in os.scandir(path) if entry.is_file())
+            self.names = [name for name, _ in entries]
+            self.sizes = np.array([st.st_size for _, st in entries], dtype=np.int64)
+            self.mtimes = np.array([st.st_mtime_ns for _, st in entries], dtype=np.int64)
+            self.dims = np.full((len(entries), 2), -1, dtype=np.int32)
+            self.labels = None
+        if self.labels is None and label_fn is not None:
+            self.labels = [label_fn(name) for name in self.names]
+        self.name_set = set(self.names)
+        self.name_index = None
+        self.dims_loaded = bool((self.dims >= 0).all())
+        if not loaded:
+            self.save()
+
+    def save(self):
+        '''
+        Write the manifest atomically and remove the stale manifests of the same folder. Every process writes
+        its own temporary file, so data loader workers or ranks saving at the same time never clobber each other.
+        '''
+        folder = os.path.dirname(self.manifest_path)
+        tmp_path = None
+        try:
+            os.makedirs(folder, exist_ok=True)
+            arrays = {'names': np.array(self.names), 'sizes': self.sizes, 'mtimes': self.mtimes, 'dims': self.dims}
+            if self.labels is not None:
+                arrays['labels'] = np.array(self.labels)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=self.key, dir=folder)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.manifest_path)
+            tmp_path = None
+            for name in os.listdir(folder):
+                # .tmp files are saves of other processes still in progress
+                if name.startswith(self.key) and not name.endswith('.tmp') and name != os.path.basename(self.manifest_path):
+                    try:
+                        os.remove(os.path.join(folder, name))
+                    except FileNotFoundError:
+                        pass # already removed by another process
+        except OSError as e:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print("Could not write the manifest of {}: {}".format(self.path, e))
+
+    def image_size(self, img_name):
+        '''
+        img_name: file name in the folder
+        Output: (width, height) of the image. The first call reads the headers of all images and saves them.
+        '''
+        if self.name_index is None:
+            self.name_index = {name: i for i, name in enumerate(self.names)}
+        if not self.dims_loaded:
+            self.dims = np.array([Image.open(os.path.join(self.path, name)).size for name in self.names], dtype=np.int32).reshape(-1, 2)
+            self.dims_loaded = True
+            self.save()
+        w, h = self.dims[self.name_index[img_name]]
+        return int(w), int(h)
+
+    def __contains__(self, img_name):
+        return img_name in self.name_set
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+class image_cache(object):
+    def __init__(self, max_bytes):
+        '''
+        LRU cache of decoded images bounded by their total size in bytes, for datasets cropping several words
+        out of one scene image. Every data loading worker has its own copy of the cache, the hit and miss
+        counters are in shared memory so the main process sees the (approximate) totals of all workers.
+        max_bytes: capacity, 0 disables caching
+        '''
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.counters = torch.zeros(2, dtype=torch.int64).share_memory_() # hits, misses
+
+    def imread(self, path):
+        '''
+        path: image path
+        Output: decoded uint8 image [H, W, C] in BGR order, shared with the cache so it must not be modified
+        '''
+        IMG = self.images.get(path)
+        if IMG is not None:
+            self.images.move_to_end(path)
+            self.counters[0] += 1
+            return IMG
+        self.counters[1] += 1
+        IMG = cv2.imread(path)
+        if IMG is None or IMG.nbytes > self.max_bytes:
+            return IMG
+        self.images[path] = IMG
+        self.bytes += IMG.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self.images.popitem(last=False)
+            self.bytes -= evicted.nbytes
+        return IMG
+
+    def stats(self):
+        '''
+        Output: dict of hits, misses and hit rate over all workers
+        '''
+        hits, misses = self.counters.tolist()
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1)}
+
 class svt_dataset_builder(data.Dataset):
-    def __init__(self, height, width, seq_len, total_img_path, xml_path):
+    def __init__(self, height, width, seq_len, total_img_path, xml_path, cache_bytes=0):
         '''
         height: input height to model
         width: input width to model
         total_img_path: path with all images
         xml_path: xml labeling file
         seq_len: sequence length
+        cache_bytes: capacity of the decoded image cache per worker, see image_cache
         '''
         # parse xml file and create fully ready dataset
         self.total_img_path = total_img_path
         self.height = height
         self.width = width
         self.seq_len = seq_len
+        self.cache = image_cache(cache_bytes)
         self.dictionary = svt_xml_extractor(xml_path)
-        self.total_img_name = os.listdir(total_img_path)
+        self.total_img_name = directory_manifest(total_img_path)
         self.dataset = []
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
@@ -182,9 +416,13 @@ class svt_dataset_builder(data.Dataset):
             if items[0] in self.total_img_name:
                 self.dataset.append([items[0],items[1],items[2]])
 
-    def __getitem__(self, index):
+    def load(self, index):
+        '''
+        index: sample index
+        Output: cropped and resized uint8 image [H, W, C] in BGR order, label string
+        '''
         img_name, bdb, label = self.dataset[index]
-        IMG = cv2.imread(os.path.join(self.total_img_path,img_name))
+        IMG = self.cache.imread(os.path.join(self.total_img_path,img_name))
         x, y, w, h = bdb
         (H, W, _) = IMG.shape
         x = max(0, x)
@@ -198,24 +436,31 @@ class svt_dataset_builder(data.Dataset):
         # image processing:
         IMG = IMG[y:y+h,x:x+w,:] # crop
         IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        IMG = (IMG - 127.5)/127.5 # normalization to [-1,1]
-        IMG = torch.FloatTensor(IMG) # convert to tensor [H, W, C]
-        IMG = IMG.permute(2,0,1) # [C, H, W]
-        y_true = np.ones(self.seq_len)*self.char2id['PAD'] # initialize y_true with 'PAD', size [seq_len]
+
+        return IMG, label
+
+    def __getitem__(self, index):
+        IMG, label = self.load(index)
+        IMG = torch.from_numpy(IMG) # uint8 tensor [H, W, C], normalized per batch by normalize_batch
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
         # label processing
         for i, c in enumerate(label):
             index = self.char2id[c]
             y_true[i] = index
         y_true[-1] = self.char2id['END'] # always put 'END' in the end
-        y_true = y_true.astype(int) # must to integer index for one-hot encoding
-        # convert to one-hot encoding
-        y_onehot = np.eye(self.output_classes)[y_true] # [seq_len, output_classes]
 
-        return IMG, torch.FloatTensor(y_onehot)
+        return IMG, torch.from_numpy(y_true)
 
     def __len__(self):
         return len(self.dataset)
 
+    def image_ids(self):
+        '''
+        Output: list of the source image id of every sample, for image_group_sampler
+        '''
+        ids = {}
+        return [ids.setdefault(img_name, len(ids)) for img_name, _, _ in self.dataset]
+
 class iiit5k_dataset_builder(data.Dataset):
     def __init__(self, height, width, seq_len, total_img_path, annotation_path):
         '''
@@ -230,7 +475,7 @@ class iiit5k_dataset_builder(data.Dataset):
         self.width = width
         self.seq_len = seq_len
         self.dictionary = iiit5k_mat_extractor(annotation_path)
-        self.total_img_name = os.listdir(total_img_path)
+        self.total_img_name = directory_manifest(total_img_path)
         self.dataset = []
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
@@ -239,65 +484,91 @@ class iiit5k_dataset_builder(data.Dataset):
             if items[0].split('/')[-1] in self.total_img_name:
                 self.dataset.append([items[0].split('/')[-1],items[1]])
 
-    def __getitem__(self, index):
+    def load(self, index):
+        '''
+        index: sample index
+        Output: resized uint8 image [H, W, C] in BGR order, label string
+        '''
         img_name, label = self.dataset[index]
         IMG = cv2.imread(os.path.join(self.total_img_path,img_name))
         IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        IMG = (IMG - 127.5)/127.5 # normalization to [-1,1]
-        IMG = torch.FloatTensor(IMG) # convert to tensor [H, W, C]
-        IMG = IMG.permute(2,0,1) # [C, H, W]
-        y_true = np.ones(self.seq_len)*self.char2id['PAD'] # initialize y_true with 'PAD', size [seq_len]
+
+        return IMG, label
+
+    def __getitem__(self, index):
+        IMG, label = self.load(index)
+        IMG = torch.from_numpy(IMG) # uint8 tensor [H, W, C], normalized per batch by normalize_batch
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
         # label processing
         for i, c in enumerate(label):
             index = self.char2id[c]
             y_true[i] = index
         y_true[-1] = self.char2id['END'] # always put 'END' in the end
-        y_true = y_true.astype(int) # must to integer index for one-hot encoding
-        # convert to one-hot encoding
-        y_onehot = np.eye(self.output_classes)[y_true] # [seq_len, output_classes]
 
-        return IMG, torch.FloatTensor(y_onehot)
+        return IMG, torch.from_numpy(y_true)
 
     def __len__(self):
         return len(self.dataset)
 
 class iiit5k_dataset_builder2(data.Dataset):
     def __init__(self, height, width, seq_len, total_img_path, 
-        annotation_path,min_w=48,max_w=160,train=True):
+        annotation_path,min_w=48,max_w=160,train=True,variable_width=False):
         '''
         height: input height to model
         width: input width to model
         total_img_path: path with all images
         annotation_path: mat labeling file
         seq_len: sequence length
+        variable_width: return images at their resized width instead of padding them to width,
+        batch them with bucket_batch_sampler and bucket_collate
         '''
         self.total_img_path = total_img_path
         self.height = height
         self.width = width
         self.min_w = min_w
         self.max_w = max_w
+        self.variable_width = variable_width
         self.seq_len = seq_len
+        self.end_after_label = True # 'END' follows the label instead of being the last token, kept by pack_dataset
         self.dictionary = iiit5k_mat_extractor(annotation_path)
-        self.total_img_name = os.listdir(total_img_path)
+        self.total_img_name = directory_manifest(total_img_path)
         self.dataset = []
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
 
         if train:
-            self.trans = torchvision.transforms.ColorJitter(
-                    brightness=0.0,contrast=0.0,hue=0.2)
+            self.jitter = dict(brightness=0.0,contrast=0.0,hue=0.2) # kept by pack_dataset
+            self.trans = torchvision.transforms.ColorJitter(**self.jitter)
         else:
+            self.jitter = None
             self.trans = None
         for items in self.dictionary:
             if items[0].split('/')[-1] in self.total_img_name:
                 self.dataset.append([items[0].split('/')[-1],items[1]])
 
-    def __getitem__(self, index):
+    def load(self, index):
+        '''
+        index: sample index
+        Output: aspect-ratio resized uint8 image on a random noise canvas [H, W, C] in BGR order, label string
+        With variable_width the image is returned without the canvas, [H, r_w, C] with min_w <= r_w <= max_w
+        '''
+        IMG, label, _ = self.load_valid(index)
+
+        return IMG, label
+
+    def load_valid(self, index):
+        '''
+        index: sample index
+        Output: same as load, plus the width of the image part before the noise padding
+        '''
         img_name, label = self.dataset[index]
-        background = np.random.randint(0,255,(self.height,self.width,3))
         IMG = cv2.imread(os.path.join(self.total_img_path,img_name))
         o_h,o_w,_ = IMG.shape
         r_w = int(o_w * self.height / o_h)
+        valid_w = min(max(r_w, self.min_w), self.max_w)
+        if self.variable_width:
+            return cv2.resize(IMG,(valid_w,self.height)), label, valid_w
+        background = np.random.randint(0,255,(self.height,self.width,3),dtype=np.uint8)
         IMG = cv2.resize(IMG,(r_w,self.height))
 
         if r_w<self.min_w:
@@ -312,13 +583,15 @@ class iiit5k_dataset_builder2(data.Dataset):
         # cv2.imwrite('random.jpg',background)
         # raise ''
 
+        return background, label, valid_w
+
+    def __getitem__(self, index):
+        background, label, valid_w = self.load_valid(index)
         # IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        background = (background - 127.5)/127.5 # normalization to [-1,1]
-        background = torch.FloatTensor(background) # convert to tensor [H, W, C]
-        background = background.permute(2,0,1) # [C, H, W]
+        background = torch.from_numpy(background) # uint8 tensor [H, W, C], normalized per batch by normalize_batch
         if not self.trans is None:
-            background = self.trans(background)
-        y_true = np.ones(self.seq_len)*self.char2id['PAD'] # initialize y_true with 'PAD', size [seq_len]
+            background = self.trans(background.permute(2,0,1)).permute(1,2,0).contiguous() # jitter on [C, H, W]
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
         # label processing
         for i, c in enumerate(label):
             index = self.char2id[c]
@@ -327,15 +600,30 @@ class iiit5k_dataset_builder2(data.Dataset):
             y_true[len(label)] = self.char2id['END']
         else:
             y_true[-1] = self.char2id['END'] # always put 'END' in the end
-        y_true = y_true.astype(int) # must to integer index for one-hot encoding
-        # convert to one-hot encoding
-        y_onehot = np.eye(self.output_classes)[y_true] # [seq_len, output_classes]
 
-        return background, torch.FloatTensor(y_onehot)
+        return background, torch.from_numpy(y_true), valid_w
 
     def __len__(self):
         return len(self.dataset)
 
+    def widths(self):
+        '''
+        Output: list of the resized width of every sample, read from the image headers without decoding
+        and kept in the folder manifest
+        '''
+        widths = []
+        for img_name, _ in self.dataset:
+            o_w, o_h = self.total_img_name.image_size(img_name)
+            r_w = int(o_w * self.height / o_h)
+            widths.append(min(max(r_w, self.min_w), self.max_w))
+        return widths
+
+    def label_lengths(self):
+        '''
+        Output: list of the label length of every sample
+        '''
+        return [len(label) for _, label in self.dataset]
+
 class syn90k_dataset_builder(data.Dataset):
     def __init__(self, height, width, seq_len, total_img_path):
         '''
@@ -348,33 +636,33 @@ class syn90k_dataset_builder(data.Dataset):
         self.height = height
         self.width = width
         self.seq_len = seq_len
-        self.total_img_name = os.listdir(total_img_path)
-        self.dataset = []
+        self.total_img_name = directory_manifest(total_img_path, label_fn=syn90k_label)
+        self.dataset = [[img_name, label] for img_name, label in zip(self.total_img_name.names, self.total_img_name.labels)]
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
 
-        for img_name in self.total_img_name:
-            _, label, _ = img_name.split('_')
-            self.dataset.append([img_name, label])
-
-    def __getitem__(self, index):
+    def load(self, index):
+        '''
+        index: sample index
+        Output: resized uint8 image [H, W, C] in BGR order, label string
+        '''
         img_name, label = self.dataset[index]
         IMG = cv2.imread(os.path.join(self.total_img_path,img_name))
         IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        IMG = (IMG - 127.5)/127.5 # normalization to [-1,1]
-        IMG = torch.FloatTensor(IMG) # convert to tensor [H, W, C]
-        IMG = IMG.permute(2,0,1) # [C, H, W]
-        y_true = np.ones(self.seq_len)*self.char2id['PAD'] # initialize y_true with 'PAD', size [seq_len]
+
+        return IMG, label
+
+    def __getitem__(self, index):
+        IMG, label = self.load(index)
+        IMG = torch.from_numpy(IMG) # uint8 tensor [H, W, C], normalized per batch by normalize_batch
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
         # label processing
         for i, c in enumerate(label):
             index = self.char2id[c]
             y_true[i] = index
         y_true[-1] = self.char2id['END'] # always put 'END' in the end
-        y_true = y_true.astype(int) # must to integer index for one-hot encoding
-        # convert to one-hot encoding
-        y_onehot = np.eye(self.output_classes)[y_true] # [seq_len, output_classes]
 
-        return IMG, torch.FloatTensor(y_onehot)
+        return IMG, torch.from_numpy(y_true)
 
     def __len__(self):
         return len(self.dataset)
@@ -391,43 +679,67 @@ class talenglish_dataset_builder(data.Dataset):
         self.height = height
         self.width = width
         self.seq_len = seq_len
-        self.total_img_name = os.listdir(total_img_path)
-        self.dataset = []
+        self.total_img_name = directory_manifest(total_img_path, label_fn=syn90k_label)
+        self.dataset = [[img_name, label] for img_name, label in zip(self.total_img_name.names, self.total_img_name.labels)]
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
 
-        for img_name in self.total_img_name:
-            _, label, _ = img_name.split('_')
-            self.dataset.append([img_name, label])
-
 
 
 class synthtext_dataset_builder(data.Dataset):
-    def __init__(self, height, width, seq_len, total_img_path, annotation_path):
+    def __init__(self, height, width, seq_len, total_img_path, annotation_path, cache_bytes=0):
         '''
         height: input height to model
         width: input width to model
         total_img_path: path with all images
         annotation_path: mat labeling file
         seq_len: sequence length
+        cache_bytes: capacity of the decoded image cache per worker, see image_cache
         '''
         self.total_img_path = total_img_path
         self.height = height
         self.width = width
         self.seq_len = seq_len
-        self.dictionary = synthtext_mat_extractor(annotation_path)
-        self.total_img_name = os.listdir(total_img_path)
-        self.dataset = []
+        self.cache = image_cache(cache_bytes)
+        self.total_img_name = directory_manifest(total_img_path)
         self.voc, self.char2id, _ = dictionary_generator()
         self.output_classes = len(self.voc)
 
-        for items in self.dictionary:
-            if items[0] in self.total_img_name:
-                self.dataset.append([items[0],items[1],items[2]])
+        index_path = annotation_path if os.path.isdir(annotation_path) else synthtext_index_path(annotation_path)
+        if os.path.isdir(index_path):
+            # boxes and labels stay memory-mapped, only the words of the images in total_img_path are indexed
+            self.names = np.load(os.path.join(index_path, 'names.npy'))
+            self.image_index = np.load(os.path.join(index_path, 'image_index.npy'), mmap_mode='r')
+            self.boxes = np.load(os.path.join(index_path, 'boxes.npy'), mmap_mode='r')
+            self.label_offsets = np.load(os.path.join(index_path, 'label_offsets.npy'), mmap_mode='r')
+            self.labels = np.load(os.path.join(index_path, 'labels.npy'), mmap_mode='r')
+            keep = np.array([name.decode('utf-8') in self.total_img_name for name in self.names], dtype=bool)
+            self.dataset = np.nonzero(keep[self.image_index])[0]
+        else:
+            print("No index found at {}, parsing {}. Convert it once with convert_synthtext.py for a fast startup.".format(index_path, annotation_path))
+            self.names = None
+            self.dataset = [items for items in synthtext_mat_extractor(annotation_path) if items[0] in self.total_img_name]
 
-    def __getitem__(self, index):
-        img_name, bdb, label = self.dataset[index]
-        IMG = cv2.imread(os.path.join(self.total_img_path,img_name))
+    def word(self, index):
+        '''
+        index: sample index
+        Output: image name, bounding box (xmin, ymin, xmax, ymax), label string
+        '''
+        if self.names is None:
+            return self.dataset[index]
+        word_id = self.dataset[index]
+        img_name = self.names[self.image_index[word_id]].decode('utf-8')
+        bdb = [int(v) for v in self.boxes[word_id]]
+        label = self.labels[self.label_offsets[word_id]:self.label_offsets[word_id+1]].tobytes().decode('utf-8')
+        return img_name, bdb, label
+
+    def load(self, index):
+        '''
+        index: sample index
+        Output: cropped and resized uint8 image [H, W, C] in BGR order, label string
+        '''
+        img_name, bdb, label = self.word(index)
+        IMG = self.cache.imread(os.path.join(self.total_img_path,img_name))
         xmin, ymin, xmax, ymax = bdb
         (H, W, _) = IMG.shape
         xmin = max(0, xmin)
@@ -441,24 +753,33 @@ class synthtext_dataset_builder(data.Dataset):
         # image processing:
         IMG = IMG[ymin:ymax+1,xmin:xmax+1,:] # crop
         IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        IMG = (IMG - 127.5)/127.5 # normalization to [-1,1]
-        IMG = torch.FloatTensor(IMG) # convert to tensor [H, W, C]
-        IMG = IMG.permute(2,0,1) # [C, H, W]
-        y_true = np.ones(self.seq_len)*self.char2id['PAD'] # initialize y_true with 'PAD', size [seq_len]
+
+        return IMG, label
+
+    def __getitem__(self, index):
+        IMG, label = self.load(index)
+        IMG = torch.from_numpy(IMG) # uint8 tensor [H, W, C], normalized per batch by normalize_batch
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
         # label processing
         for i, c in enumerate(label):
             index = self.char2id[c]
             y_true[i] = index
         y_true[-1] = self.char2id['END'] # always put 'END' in the end
-        y_true = y_true.astype(int) # must to integer index for one-hot encoding
-        # convert to one-hot encoding
-        y_onehot = np.eye(self.output_classes)[y_true] # [seq_len, output_classes]
 
-        return IMG, torch.FloatTensor(y_onehot)
+        return IMG, torch.from_numpy(y_true)
 
     def __len__(self):
         return len(self.dataset)
 
+    def image_ids(self):
+        '''
+        Output: list of the source image id of every sample, for image_group_sampler
+        '''
+        if self.names is None:
+            ids = {}
+            return [ids.setdefault(img_name, len(ids)) for img_name, _, _ in self.dataset]
+        return self.image_index[self.dataset].tolist()
+
 class test_dataset_builder(data.Dataset):
     def __init__(self, height, width, img_path):
         '''
@@ -474,16 +795,442 @@ class test_dataset_builder(data.Dataset):
     def __getitem__(self, index):
         IMG = cv2.imread(os.path.join(self.img_path, self.dataset[index]))
         # image processing:
-        IMG = cv2.resize(IMG, (self.width, self.height)) # resize
-        IMG = (IMG - 127.5)/127.5 # normalization to [-1,1]
-        IMG = torch.FloatTensor(IMG) # convert to tensor [H, W, C]
-        IMG = IMG.permute(2,0,1) # [C, H, W]
+        IMG = preprocess_image(IMG, self.height, self.width)
 
         return IMG, self.dataset[index]
 
     def __len__(self):
         return len(self.dataset)
 
+def box_quad(box):
+    '''
+    box: word box as [xmin, ymin, xmax, ymax], 8 numbers x1, y1, ..., x4, y4, 4 points [[x, y], ...]
+    or the SynthText wordBB shape [[x1, ..., x4], [y1, ..., y4]], points in the order top-left,
+    top-right, bottom-right, bottom-left
+    Output: float32 array [4, 2] of the corner points
+    '''
+    box = np.array(box, dtype=np.float32)
+    if box.shape == (4,):
+        xmin, ymin, xmax, ymax = box
+        return np.array([[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]], dtype=np.float32)
+    if box.shape == (8,):
+        return box.reshape(4, 2)
+    if box.shape == (4, 2):
+        return box
+    if box.shape == (2, 4):
+        return np.ascontiguousarray(box.T)
+    raise ValueError("unsupported box shape {}".format(box.shape))
+
+def crop_box(IMG, box, height, width):
+    '''
+    IMG: uint8 scene image [H, W, C] in BGR order
+    box: word box, see box_quad
+    height: input height to model
+    width: input width to model
+    Output: uint8 word image [height, width, C], the box warped in one step so quadrilaterals are rectified
+    '''
+    src = box_quad(box)
+    dst = np.array([[0, 0], [width-1, 0], [width-1, height-1], [0, height-1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(IMG, M, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+class scene_dataset_builder(data.Dataset):
+    def __init__(self, height, width, box_path, img_path=''):
+        '''
+        Full scene images with the word boxes of a detector, every item is one scene decoded once.
+        height: input height to model
+        width: input width to model
+        box_path: JSON lines file, one {"image": path, "boxes": [box, ...]} per scene, see box_quad for the box formats
+        img_path: folder of relative image paths
+        '''
+        self.height = height
+        self.width = width
+        self.img_path = img_path
+        self.dataset = []
+        with open(box_path) as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                scene = json.loads(line)
+                self.dataset.append((scene['image'], scene['boxes']))
+
+    def __getitem__(self, index):
+        '''
+        Output: uint8 word images [boxes, height, width, C], list of names "image box_index"
+        '''
+        img_name, boxes = self.dataset[index]
+        IMG = cv2.imread(os.path.join(self.img_path, img_name))
+        if IMG is None:
+            print("Cannot read image {}, skipped".format(img_name))
+            boxes = []
+        crops = np.zeros((len(boxes), self.height, self.width, 3), dtype=np.uint8)
+        for i, box in enumerate(boxes):
+            crops[i] = crop_box(IMG, box, self.height, self.width)
+
+        return torch.from_numpy(crops), ['{} {}'.format(img_name, i) for i in range(len(boxes))]
+
+    def __len__(self):
+        return len(self.dataset)
+
+def scene_collate(batch):
+    '''
+    batch: list of (uint8 word images [boxes, H, W, C], names) of scene_dataset_builder
+    Output: word images of all scenes [words, H, W, C], names
+    '''
+    crops, names = zip(*batch)
+    return torch.cat(crops), [name for scene_names in names for name in scene_names]
+
+class crop_batches(object):
+    def __init__(self, dataloader, batch_size, pin_memory=False):
+        '''
+        Regroup the word images of a scene_dataset_builder loader into batches of batch_size words across scenes.
+        dataloader: DataLoader with scene_collate
+        batch_size: words per batch
+        pin_memory: pin the regrouped batches for an asynchronous copy to CUDA
+        '''
+        self.dataloader = dataloader
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory
+
+    def _batch(self, crops, names):
+        x = torch.cat(crops)
+        return (x.pin_memory() if self.pin_memory else x), names
+
+    def __iter__(self):
+        crops = []
+        names = []
+        count = 0
+        for x, scene_names in self.dataloader:
+            crops.append(x)
+            names += scene_names
+            count += len(x)
+            while count >= self.batch_size:
+                x = torch.cat(crops)
+                yield self._batch([x[:self.batch_size]], names[:self.batch_size])
+                crops = [x[self.batch_size:]]
+                names = names[self.batch_size:]
+                count -= self.batch_size
+        if count > 0:
+            yield self._batch(crops, names)
+
+dataset_types = ('svt', 'iiit5k', 'iiit5k2', 'syn90k', 'synthtext', 'packed') # types known to build_dataset
+
+def build_dataset(dataset_type, dataset_path, height, width, seq_len, cache_bytes=0, variable_width=False):
+    '''
+    Create the train and test splits of a dataset laid out as expected by train.py
+    Input:
+    dataset_type: svt|iiit5k|iiit5k2|syn90k|synthtext|packed
+    dataset_path: dataset folder
+    height: input height to model
+    width: input width to model
+    seq_len: sequence length
+    cache_bytes: size of the decoded scene image cache of svt and synthtext, 0 to disable it
+    variable_width: iiit5k2 returns images at their resized width, for bucket_batch_sampler
+    Output: train dataset, test dataset
+    '''
+    if dataset_type == 'svt': # street view text dataset
+        img_path = os.path.join(dataset_path, 'img')
+        train_dataset = svt_dataset_builder(height, width, seq_len, img_path, os.path.join(dataset_path, 'train.xml'), cache_bytes)
+        test_dataset = svt_dataset_builder(height, width, seq_len, img_path, os.path.join(dataset_path, 'test.xml'), cache_bytes)
+    elif dataset_type == 'iiit5k': # IIIT5k dataset
+        train_dataset = iiit5k_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'train'), os.path.join(dataset_path, 'traindata.mat'))
+        test_dataset = iiit5k_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'test'), os.path.join(dataset_path, 'testdata.mat'))
+    elif dataset_type == 'iiit5k2': # IIIT5k dataset with aspect-ratio resizing
+        train_dataset = iiit5k_dataset_builder2(height, width, seq_len, os.path.join(dataset_path, 'train'), os.path.join(dataset_path, 'traindata.mat'), train=True, variable_width=variable_width)
+        test_dataset = iiit5k_dataset_builder2(height, width, seq_len, os.path.join(dataset_path, 'test'), os.path.join(dataset_path, 'testdata.mat'), train=False, variable_width=variable_width)
+    elif dataset_type == 'syn90k': # Syn90K dataset
+        train_dataset = syn90k_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'train'))
+        test_dataset = syn90k_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'test'))
+    elif dataset_type == 'synthtext': # SynthText dataset
+        annotation_path = os.path.join(dataset_path, 'gt.mat')
+        train_dataset = synthtext_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'train'), annotation_path, cache_bytes)
+        test_dataset = synthtext_dataset_builder(height, width, seq_len, os.path.join(dataset_path, 'test'), annotation_path, cache_bytes)
+    elif dataset_type == 'packed': # output folder of pack_dataset.py
+        train_dataset = packed_dataset_builder(seq_len, os.path.join(dataset_path, 'train'))
+        test_dataset = packed_dataset_builder(seq_len, os.path.join(dataset_path, 'test'))
+    else:
+        raise ValueError("dataset type {} is not supported".format(dataset_type))
+
+    return train_dataset, test_dataset
+
+class bucket_batch_sampler(data.Sampler):
+    def __init__(self, widths, batch_size, bucket_width=8, lengths=None, length_bucket=4, shuffle=True, drop_last=False, seed=0):
+        '''
+        Batch sampler that only batches samples of similar width, so a batch is padded to its own max width.
+        widths: list of the resized width of every sample
+        batch_size: samples per batch
+        bucket_width: width granularity in pixels of a bucket, 8 is one feature map column
+        lengths: optional list of label lengths, also bucketed by length_bucket characters
+        shuffle: shuffle samples inside buckets and the order of batches, set_epoch() gives a new order
+        drop_last: drop the last incomplete batch of every bucket
+        seed: with the epoch, seed of the shuffle, so the batches of an epoch can be reproduced when resuming
+        '''
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = {}
+        for index, width in enumerate(widths):
+            key = (width + bucket_width - 1) // bucket_width
+            if lengths is not None:
+                key = (key, lengths[index] // length_bucket)
+            self.buckets.setdefault(key, []).append(index)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for indices in self.buckets.values():
+            indices = list(indices)
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start+self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum((len(indices) + self.batch_size - 1) // self.batch_size for indices in self.buckets.values())
+
+class skip_sampler(data.Sampler):
+    def __init__(self, sampler):
+        '''
+        Wrap a sampler or batch sampler with a deterministic order per epoch, e.g. DistributedSampler or
+        bucket_batch_sampler, so an interrupted epoch can be resumed at the sample (or batch) it stopped at.
+        sampler: sampler with set_epoch()
+        '''
+        self.sampler = sampler
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def skip(self, start):
+        '''
+        start: number of items to drop from the next iteration only
+        '''
+        self.start = start
+
+    def __iter__(self):
+        start = self.start
+        self.start = 0
+        return itertools.islice(iter(self.sampler), start, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.start, 0)
+
+class shard_sampler(data.Sampler):
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        '''
+        Sampler that gives every distributed process the samples rank, rank + num_replicas, ... in order. Unlike
+        DistributedSampler it does not pad the shards with repeated samples, so metrics summed over all
+        processes count every sample exactly once.
+        data_source: dataset
+        num_replicas: number of distributed processes
+        rank: rank of this process
+        '''
+        self.data_source = data_source
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_source), self.num_replicas))
+
+class image_group_sampler(data.Sampler):
+    def __init__(self, image_ids, shuffle=True, seed=0, num_replicas=1, rank=0):
+        '''
+        Sampler that yields the words of one source image one after another, so consecutive samples, which
+        land in the same batch and worker, hit the image_cache of the dataset.
+        image_ids: list of the source image id of every sample, from image_ids() of the dataset
+        shuffle: shuffle the order of the images and of the words inside an image, set_epoch() gives a new order
+        seed: with the epoch, seed of the shuffle
+        num_replicas: number of distributed processes, each gets a contiguous part of the order
+        rank: rank of this process
+        '''
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.groups = {}
+        for index, image_id in enumerate(image_ids):
+            self.groups.setdefault(image_id, []).append(index)
+        self.num_samples = (len(image_ids) + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        groups = [list(indices) for indices in self.groups.values()]
+        if self.shuffle:
+            rng.shuffle(groups)
+            for indices in groups:
+                rng.shuffle(indices)
+        order = [index for indices in groups for index in indices]
+        order += order[:self.num_samples * self.num_replicas - len(order)] # pad to an equal share per process
+        return iter(order[self.rank * self.num_samples:(self.rank + 1) * self.num_samples])
+
+    def __len__(self):
+        return self.num_samples
+
+def bucket_collate(batch, multiple=8):
+    '''
+    Collate images of different widths by padding them to the max width of the batch, rounded up to multiple.
+    batch: list of (uint8 image [H, w, C], label [seq_len], valid width w)
+    Output: uint8 images [batch, H, W, C] padded with random noise as in iiit5k_dataset_builder2, labels [batch, seq_len],
+    valid widths [batch]
+    '''
+    images, labels, widths = zip(*batch)
+    H, _, C = images[0].shape
+    W = max(image.size(1) for image in images)
+    W = (W + multiple - 1) // multiple * multiple
+    x = torch.randint(0, 255, (len(images), H, W, C), dtype=torch.uint8)
+    for i, image in enumerate(images):
+        x[i,:,:image.size(1)] = image
+
+    return x, torch.stack(labels), torch.tensor(widths)
+
+def padding_waste(widths, batches, multiple=8):
+    '''
+    widths: list of the resized width of every sample
+    batches: iterable of lists of sample indices, e.g. a batch sampler
+    multiple: padded widths are rounded up to this multiple as in bucket_collate
+    Output: fraction of the batched image columns that are padding
+    '''
+    padded = 0
+    valid = 0
+    for batch in batches:
+        W = max(widths[index] for index in batch)
+        W = (W + multiple - 1) // multiple * multiple
+        padded += W * len(batch)
+        valid += sum(widths[index] for index in batch)
+
+    return 1.0 - valid / max(padded, 1)
+
+_pack_source = None
+_pack_images = None
+
+def _pack_init(source, images_path, reseed=False):
+    global _pack_source, _pack_images
+    if reseed:
+        np.random.seed() # forked workers inherit the numpy state of the parent, the noise padding would repeat across them
+    _pack_source = source
+    _pack_images = np.load(images_path, mmap_mode='r+')
+
+def _pack_chunk(bounds):
+    start, end = bounds
+    labels = []
+    widths = []
+    for index in range(start, end):
+        if hasattr(_pack_source, 'load_valid'):
+            _pack_images[index], label, valid_w = _pack_source.load_valid(index)
+            widths.append(valid_w)
+        else:
+            _pack_images[index], label = _pack_source.load(index)
+        labels.append(label)
+    _pack_images.flush()
+    return labels, widths
+
+def pack_dataset(source, pack_path, workers=4, chunk_size=1024):
+    '''
+    Pre-crop and resize every sample of a dataset builder into a packed dataset folder:
+    images.npy: uint8 array [N, H, W, C] in BGR order, read back memory-mapped
+    offsets.npy: int64 array [N+1], label i is codes[offsets[i]:offsets[i+1]]
+    codes.npy: uint8 array of character ids from dictionary_generator
+    widths.npy: int64 array [N] of the valid image widths, only for sources with load_valid such as iiit5k2
+    meta.json: target convention of the source, end_after_label puts 'END' right after the label,
+    and color_jitter, the ColorJitter arguments of a training source, which are applied at read time
+    Input:
+    source: dataset builder providing load(index) -> (uint8 image [H, W, C], label string),
+    or load_valid(index) -> (uint8 image [H, W, C], label string, valid width)
+    pack_path: output folder
+    workers: number of processes doing the image decoding
+    chunk_size: samples per task
+    '''
+    os.makedirs(pack_path, exist_ok=True)
+    _, char2id, _ = dictionary_generator()
+    images_path = os.path.join(pack_path, 'images.npy')
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(len(source), source.height, source.width, 3))
+    del images # flushed header, workers reopen it
+    chunks = [(start, min(start+chunk_size, len(source))) for start in range(0, len(source), chunk_size)]
+    if workers > 1:
+        with Pool(workers, initializer=_pack_init, initargs=(source, images_path, True)) as pool:
+            results = list(pool.imap(_pack_chunk, chunks))
+    else:
+        _pack_init(source, images_path)
+        results = list(map(_pack_chunk, chunks))
+    labels = [label for chunk_labels, _ in results for label in chunk_labels]
+    widths = [valid_w for _, chunk_widths in results for valid_w in chunk_widths]
+    lengths = np.array([len(label) for label in labels], dtype=np.int64)
+    offsets = np.zeros(len(labels)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    codes = np.array([char2id[c] for label in labels for c in label], dtype=np.uint8)
+    np.save(os.path.join(pack_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(pack_path, 'codes.npy'), codes)
+    if hasattr(source, 'load_valid'):
+        np.save(os.path.join(pack_path, 'widths.npy'), np.array(widths, dtype=np.int64))
+    with open(os.path.join(pack_path, 'meta.json'), 'w') as f:
+        json.dump({'end_after_label': getattr(source, 'end_after_label', False),
+                   'color_jitter': getattr(source, 'jitter', None)}, f)
+
+class packed_dataset_builder(data.Dataset):
+    def __init__(self, seq_len, pack_path):
+        '''
+        seq_len: sequence length
+        pack_path: folder written by pack_dataset
+        '''
+        self.pack_path = pack_path
+        self.seq_len = seq_len
+        self.images = np.load(os.path.join(pack_path, 'images.npy'), mmap_mode='c') # [N, H, W, C], copy-on-write so samples are read without a copy
+        self.offsets = np.load(os.path.join(pack_path, 'offsets.npy'))
+        self.codes = np.load(os.path.join(pack_path, 'codes.npy'))
+        widths_path = os.path.join(pack_path, 'widths.npy')
+        self.valid_widths = np.load(widths_path) if os.path.exists(widths_path) else None # [N]
+        meta_path = os.path.join(pack_path, 'meta.json')
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        self.end_after_label = meta.get('end_after_label', False)
+        jitter = meta.get('color_jitter')
+        self.trans = torchvision.transforms.ColorJitter(**jitter) if jitter is not None else None # random, so not packed
+        _, self.height, self.width, _ = self.images.shape
+        self.voc, self.char2id, _ = dictionary_generator()
+        self.output_classes = len(self.voc)
+
+    def __getitem__(self, index):
+        IMG = torch.from_numpy(self.images[index]) # uint8 tensor [H, W, C] viewing the memory map, nothing writes to it
+        if not self.trans is None:
+            IMG = self.trans(IMG.permute(2,0,1)).permute(1,2,0).contiguous() # jitter on [C, H, W]
+        y_true = np.full(self.seq_len, self.char2id['PAD'], dtype=np.int64) # initialize y_true with 'PAD', size [seq_len]
+        # label processing
+        label = self.codes[self.offsets[index]:self.offsets[index+1]]
+        y_true[:len(label)] = label
+        if self.end_after_label and len(label) < self.seq_len:
+            y_true[len(label)] = self.char2id['END']
+        else:
+            y_true[-1] = self.char2id['END'] # always put 'END' in the end
+
+        if self.valid_widths is not None:
+            return IMG, torch.from_numpy(y_true), int(self.valid_widths[index])
+        return IMG, torch.from_numpy(y_true)
+
+    def __len__(self):
+        return len(self.images)
+
 # unit test
 if __name__ == '__main__':
 
@@ -544,9 +1291,7 @@ if __name__ == '__main__':
 
     for i, item in enumerate(train_dataset_iiit5k2):
         print(item[0].shape,item[1].shape)
-        IMG = item[0].permute(1,2,0)
-        IMG = IMG.detach().numpy()
-        IMG = (IMG*127.5+127.5).astype(np.uint8)
+        IMG = item[0].numpy() # uint8 [H, W, C]
         cv2.imwrite('../test/iiit_'+str(i)+'.jpg', IMG)
 
     # for i, item in enumerate(train_dataset_syn90k):
@@ -561,7 +1306,7 @@ if __name__ == '__main__':
     #     IMG = item[0].permute(1,2,0)
     #     IMG = IMG.detach().numpy()
     #     IMG = (IMG*127.5+127.5).astype(np.uint8)
-    #     target = item[1].max(1)[1] # [seq_len]
+    #     target = item[1] # [seq_len]
     #     label = end_cut(target.detach().cpu().numpy(), char2id, id2char)
     #     print(label)
     #     cv2.imwrite('../test/synthtext_'+str(i)+'.jpg', IMG)
\ No newline at end of file
@@ -0,0 +1,104 @@
+'''
+This code is to export a trained SAR model with greedy decoding to TorchScript and ONNX.
+'''
+import sys
+import inspect
+import argparse
+import torch
+# internal package
+from dataset.dataset import dictionary_generator
+from models.sar import sar
+from models.export import sar_greedy
+
+def check_parity(name, predict_eager, predict_export, tolerance):
+    '''
+    name: name of the exported format in the report
+    predict_eager, predict_export: log-probabilities [batch, seq_len, output_classes]
+    tolerance: largest allowed difference of the probabilities
+    Exits non-zero when the decoded indices differ or the probabilities differ by more than tolerance.
+    '''
+    matches = torch.equal(predict_eager.max(2)[1], predict_export.max(2)[1])
+    difference = (predict_eager.exp() - predict_export.exp()).abs().max().item()
+    print(name, "matches eager:", matches, "max difference:", difference)
+    if not matches or difference > tolerance:
+        print("{} parity check failed: the decoded indices differ or the max difference is above the tolerance {}".format(name, tolerance))
+        sys.exit(1)
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='model path')
+    parser.add_argument('--output', type=str, default='sar', help='output path without extension, writes .pt and .onnx')
+    parser.add_argument('--share_weights', action='store_true', help="the checkpoint has a weight-shared decoder")
+    parser.add_argument('--stop_on_pad', action='store_true', help="also stop decoding a sequence at PAD, for models trained on targets with PAD after the word")
+    parser.add_argument('--width', type=int, default=64, help='input width of the example input')
+    parser.add_argument('--batch', type=int, default=4, help='batch size of the parity check')
+    parser.add_argument('--no_onnx', action='store_true', help="only export TorchScript")
+    parser.add_argument('--opset', type=int, default=13, help='ONNX opset version')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest allowed probability difference to the eager model')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    Height = 48
+    Width = opt.width
+    feature_height = Height // 4
+    feature_width = Width // 8
+    Channel = 3
+    voc, char2id, id2char = dictionary_generator()
+    output_classes = len(voc)
+    embedding_dim = 512
+    hidden_units = 512
+    layers = 2
+    keep_prob = 1.0
+    seq_len = 40
+
+    model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, share_weights=opt.share_weights, stop_on_pad=opt.stop_on_pad)
+    model.load_state_dict(torch.load(opt.model, map_location=lambda storage, loc: storage))
+    model = model.eval()
+
+    x = torch.rand(opt.batch, Channel, Height, Width) * 2 - 1
+    with torch.no_grad():
+        predict_eager, _, _, _ = model(x, 0)
+        scripted = torch.jit.script(sar_greedy(model))
+    scripted.save(opt.output + '.pt')
+    print("TorchScript model saved to", opt.output + '.pt')
+
+    # parity check against the eager model
+    loaded = torch.jit.load(opt.output + '.pt')
+    with torch.no_grad():
+        predict_script = loaded(x)
+    check_parity("TorchScript", predict_eager, predict_script, opt.tolerance)
+
+    if not opt.no_onnx:
+        export_options = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            export_options['dynamo'] = False # the dynamo exporter, the default from torch 2.9, does not take a ScriptModule
+        torch.onnx.export(scripted, (x,), opt.output + '.onnx', opset_version=opt.opset,
+                          input_names=['image'], output_names=['log_probs'],
+                          dynamic_axes={'image': {0: 'batch', 3: 'width'}, 'log_probs': {0: 'batch'}}, **export_options)
+        print("ONNX model saved to", opt.output + '.onnx')
+        # the in-place writes of the scripted while loop must stay a Loop op that can exit before seq_len steps
+        try:
+            import onnx
+        except ImportError:
+            print("WARNING: onnx is not installed, the ONNX graph check is SKIPPED", file=sys.stderr)
+        else:
+            graph = onnx.load(opt.output + '.onnx')
+            onnx.checker.check_model(graph)
+            loops = [node for node in graph.graph.node if node.op_type == 'Loop']
+            if len(loops) != 1:
+                print("ONNX graph check failed: expected one Loop node for the decoding loop, found {}".format(len(loops)))
+                sys.exit(1)
+            if len(loops[0].input) < 2 or loops[0].input[1] == '':
+                print("ONNX graph check failed: the decoding Loop has no condition input, it cannot stop early")
+                sys.exit(1)
+            print("ONNX graph check passed: valid model with a conditional decoding Loop")
+        try:
+            import onnxruntime
+        except ImportError:
+            print("WARNING: onnxruntime is not installed, the ONNX parity check against the eager model is SKIPPED", file=sys.stderr)
+        else:
+            session = onnxruntime.InferenceSession(opt.output + '.onnx', providers=['CPUExecutionProvider'])
+            predict_onnx = torch.from_numpy(session.run(None, {'image': x.numpy()})[0])
+            check_parity("ONNX", predict_eager, predict_onnx, opt.tolerance)
@@ -2,6 +2,7 @@
 THis is the main inference code.
 '''
 import os
+from concurrent.futures import ThreadPoolExecutor
 os.environ["CUDA_VISIBLE_DEVICES"] = "0" # set GPU id at the very begining
 import argparse
 import random
@@ -16,10 +17,9 @@ import cv2
 import pdb
 # internal package
 from dataset import dataset
-from dataset.dataset import dictionary_generator
-from models.sar import sar
-from utils.dataproc import end_cut
-from utils.attention_map import attention_map
+from models.recognizer import Recognizer
+from utils.attention_map import save_attention_map
+from utils.prefetch import loader_options, prefetch_loader
 
 # main function:
 if __name__ == '__main__':
@@ -28,10 +28,22 @@ if __name__ == '__main__':
     parser.add_argument('--batch', type=int, default=32, help='batch size')
     parser.add_argument(
         '--worker', type=int, default=4, help='number of data loading workers')
-    parser.add_argument('--input', type=str, default='', help='input folder')
+    parser.add_argument('--input', type=str, default='', help='input folder, with --boxes the folder of the relative scene image paths')
+    parser.add_argument('--boxes', type=str, default='', help='JSON lines file of full scene images and their word boxes, the words are cropped in memory')
     parser.add_argument('--output', type=str, default='predict.txt', help='output file name')
     parser.add_argument('--model', type=str, default='', help='model path')
     parser.add_argument('--gpu', type=bool, default=False, help="GPU being used or not")
+    parser.add_argument('--beam', type=int, default=1, help="beam width for decoding, 1 for greedy search")
+    parser.add_argument('--length_penalty', type=float, default=0.0, help="length normalization exponent for beam search")
+    parser.add_argument('--share_weights', action='store_true', help="share the decoder LSTM cells across time steps")
+    parser.add_argument('--stop_on_pad', action='store_true', help="also stop decoding a sequence at PAD, for models trained on targets with PAD after the word")
+    parser.add_argument('--compact', action='store_true', help="drop finished sequences from the decoding batch at every step")
+    parser.add_argument('--attention_dir', type=str, default='', help="folder to write attention map overlays to, empty to skip them")
+    parser.add_argument('--attention_rate', type=float, default=1.0, help="fraction of images whose attention maps are written")
+    parser.add_argument('--int8', action='store_true', help="int8 quantization for CPU inference")
+    parser.add_argument('--calibration', type=str, default='', help="with --int8, image folder to calibrate the backbone quantization, default is --input")
+    parser.add_argument('--calibration_batches', type=int, default=10, help="number of calibration batches, 0 keeps the backbone in float")
+    parser.add_argument('--attention_writer', type=int, default=2, help="number of background threads rendering attention maps")
     
     opt = parser.parse_args()
     print(opt)
@@ -48,74 +60,85 @@ if __name__ == '__main__':
             device = torch.device("cpu")
             print("CPU being used!")
     
-    # set training parameters
+    # set inference parameters
     Height = 48
     Width = 64
-    feature_height = Height // 4
-    feature_width = Width // 8
-    Channel = 3
-    voc, char2id, id2char = dictionary_generator()
-    output_classes = len(voc)
-    embedding_dim = 512
-    hidden_units = 512
-    layers = 2
-    keep_prob = 1.0
-    seq_len = 40
     batch_size = opt.batch
     output_path = opt.output
     trained_model_path = opt.model
     input_path = opt.input
     worker = opt.worker
+    attention_dir = opt.attention_dir
+    save_attention = attention_dir != ''
 
-    # load test data
-    test_dataset = dataset.test_dataset_builder(Height, Width, input_path)
+    if input_path == '' and opt.boxes == '':
+        print("Error: Empty --input!")
+        exit(1)
 
-    # make dataloader
-    test_dataloader = torch.utils.data.DataLoader(
-                    test_dataset,
-                    batch_size=batch_size,
-                    shuffle=False,
-                    num_workers=int(worker))
+    if opt.boxes != '':
+        # every scene is decoded once by a worker, its words are batched together with those of other scenes
+        scene_dataset = dataset.scene_dataset_builder(Height, Width, opt.boxes, input_path)
+        scene_dataloader = torch.utils.data.DataLoader(
+                        scene_dataset,
+                        batch_size=1,
+                        shuffle=False,
+                        collate_fn=dataset.scene_collate,
+                        num_workers=int(worker))
+        test_dataloader = dataset.crop_batches(scene_dataloader, batch_size, pin_memory=device.type == 'cuda')
+    else:
+        # load test data
+        test_dataset = dataset.test_dataset_builder(Height, Width, input_path)
+
+        # make dataloader
+        test_dataloader = torch.utils.data.DataLoader(
+                        test_dataset,
+                        batch_size=batch_size,
+                        shuffle=False,
+                        **loader_options(int(worker), device))
 
     # load model
     print("Create model......")
-    model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, device)
-
-    if torch.cuda.is_available() == True and opt.gpu == True:
-        model.load_state_dict(torch.load(trained_model_path, map_location=lambda storage, loc: storage), strict=False)
-        model = torch.nn.DataParallel(model).to(device)
-    else:
-        model.load_state_dict(torch.load(trained_model_path, map_location=lambda storage, loc: storage), strict=False)
-        model = model.to(device)
-
-    if input_path == '':
-        print("Error: Empty --input!")
-        exit(1)
+    calibration = None
+    if opt.int8 and opt.calibration_batches > 0:
+        if opt.calibration == '' and opt.boxes != '':
+            calibration_dataloader = test_dataloader # the first word batches of the scenes
+        else:
+            calibration_dataloader = torch.utils.data.DataLoader(
+                            dataset.test_dataset_builder(Height, Width, opt.calibration if opt.calibration != '' else input_path),
+                            batch_size=batch_size,
+                            shuffle=True,
+                            num_workers=int(worker))
+        calibration = [dataset.normalize_batch(data[0], 'cpu') for _, data in zip(range(opt.calibration_batches), calibration_dataloader)]
+    recognizer = Recognizer(trained_model_path, device, Height, Width, batch_size, opt.beam, opt.length_penalty, opt.share_weights, opt.compact, opt.stop_on_pad,
+                            int8=opt.int8, calibration=calibration)
 
-    if os.path.isfile(output_path):
-        os.remove(output_path)
+    if save_attention:
+        try:
+            os.makedirs(attention_dir)
+        except OSError:
+            pass
+        writer = ThreadPoolExecutor(max_workers=opt.attention_writer)
+        pending = []
 
     # run inference
     print("Inference starts......")
-    for i, data in enumerate(test_dataloader):
-        print("processing for batch index:", i)
-        x = data[0] # [batch_size, Channel, Height, Width]
-        image_name = data[1] # [batch_size, image_name]
-        x = x.to(device)
-        model = model.eval()
-        predict, att_weights, _, _ = model(x, 0)
-        batch_size_current = predict.shape[0]
-        pred_choice = predict.max(2)[1] # [batch_size, seq_len]
-        with open(output_path, "a") as f:
-            for idx in range(batch_size_current):
-                # prediction evaluation
-                predict_word = end_cut(pred_choice[idx].detach().cpu().numpy(), char2id, id2char)
-                # generate attention heatmap
-                heatmaps, overlayed_images = attention_map(predict_word, x[idx], att_weights[idx,:,:,:,:])
-                '''
-                for i, img in enumerate(overlayed_images):
-                    cv2.imwrite('./attmap/'+image_name[idx][:-4]+'_'+str(i)+'.png', img)
-                '''
+    with open(output_path, "w") as f:
+        test_loader = prefetch_loader(test_dataloader, device) # copies the next batch while the current one is decoded
+        for i, data in enumerate(test_loader):
+            print("processing for batch index: {} data wait: {:.3f} s".format(i, test_loader.data_time))
+            x = data[0] # [batch_size, Channel, Height, Width]
+            image_name = data[1] # [batch_size, image_name]
+            predict, att_weights = recognizer.predict(x, return_attention=save_attention)
+            for idx, (predict_word, log_prob) in enumerate(recognizer.decode(predict)):
+                # render attention heatmaps of sampled images on the writer threads
+                if save_attention and random.random() < opt.attention_rate:
+                    name = image_name[idx].split(' ') # image name, plus the box index with --boxes
+                    path_prefix = os.path.join(attention_dir, '_'.join([os.path.splitext(os.path.basename(name[0]))[0]] + name[1:]))
+                    pending.append(writer.submit(save_attention_map, path_prefix, predict_word, x[idx].cpu(), att_weights[idx,:len(predict_word)].cpu()))
                 # write to output path
-                f.write("{} {}\n".format(image_name[idx], predict_word))
+                f.write("{} {} {:.4f}\n".format(image_name[idx], predict_word, log_prob))
+    if save_attention:
+        writer.shutdown(wait=True)
+        for future in pending:
+            future.result() # raise errors of the writer threads
     print("Inference done!")
\ No newline at end of file
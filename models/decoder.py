@@ -26,7 +26,7 @@ class attention(nn.Module):
         '''
         hidden_units: hidden units of decoder
         H: height of feature map
-        W: width of feature map
+        W: width of feature map, forward() uses the size of its input so W may differ per batch
         D: depth of feature map
         '''
         self.conv1 = nn.Conv2d(hidden_units, D, kernel_size=1, stride=1)
@@ -38,29 +38,48 @@ class attention(nn.Module):
         self.W = W
         self.D = D
 
-    def forward(self, h, feature_map):
+    def project(self, feature_map):
         '''
-        h: hidden state from decoder output, with size [batch, hidden_units]
+        feature_map: feature map from backbone network, with size [batch, D, H, W]
+        The projection only depends on the feature map, so it is computed once per image
+        and reused at every decoding step.
+        '''
+        return self.conv2(feature_map) # [batch, D, H, W]
+
+    def forward(self, h, feature_map, feature_proj=None, mask=None):
+        '''
+        h: hidden state from decoder output, with size [batch*beam, hidden_units]
         feature_map: feature map from backbone network, with size [batch, channel, H, W]
+        feature_proj: optional precomputed project(feature_map), with size [batch, D, H, W]
+        mask: optional bool mask of the valid (not padded) columns, with size [batch, W],
+        padded columns get no attention weight
+        With beam > 1 the beam hypotheses of an image are consecutive rows of h and share
+        its feature map, which is broadcast instead of being copied per beam.
         '''
-        # reshape hidden state [batch, hidden_units] to [batch, hidden_units, 1, 1]
+        if feature_proj is None:
+            feature_proj = self.project(feature_map)
+        batch_size, D, H, W = feature_map.shape
+        beam = h.size(0) // batch_size
+        # reshape hidden state [batch*beam, hidden_units] to [batch*beam, hidden_units, 1, 1]
         h = h.unsqueeze(2)
         h = h.unsqueeze(3)
-        h = self.conv1(h) # [batch, D, 1, 1]
-        h = h.repeat(1, 1, self.H, self.W) # tiling to [batch, D, H, W]
-        feature_map_origin = feature_map
-        feature_map = self.conv2(feature_map) # [batch, D, H, W]
-        combine = self.conv3(self.dropout(torch.tanh(feature_map + h))) # [batch, 1, H, W]
-        combine_flat = combine.view(combine.size(0), -1) # resize to [batch, H*W]
-        attention_weights = self.softmax(combine_flat) # [batch, H*W]
-        attention_weights = attention_weights.view(combine.size()) # [batch, 1, H, W]
-        glimpse = feature_map_origin * attention_weights.repeat(1, self.D, 1, 1) # [batch, D, H, W]
-        glimpse = torch.sum(glimpse, dim=(2,3)) # [batch, D]
+        h = self.conv1(h) # [batch*beam, D, 1, 1]
+        h = h.view(batch_size, beam, D, 1, 1) # broadcast over [H, W]
+        combine = torch.tanh(feature_proj.unsqueeze(1) + h) # [batch, beam, D, H, W]
+        combine = self.conv3(self.dropout(combine.view(batch_size*beam, D, H, W))) # [batch*beam, 1, H, W]
+        combine_flat = combine.view(batch_size, beam, -1) # resize to [batch, beam, H*W]
+        if mask is not None:
+            mask = mask.unsqueeze(1).expand(batch_size, H, W).reshape(batch_size, 1, H*W)
+            combine_flat = combine_flat.masked_fill(~mask, float('-inf'))
+        attention_weights = self.softmax(combine_flat) # [batch, beam, H*W]
+        glimpse = torch.bmm(attention_weights, feature_map.reshape(batch_size, D, H*W).transpose(1,2)) # [batch, beam, D]
+        glimpse = glimpse.view(batch_size*beam, D) # [batch*beam, D]
+        attention_weights = attention_weights.view(combine.size()) # [batch*beam, 1, H, W]
 
         return glimpse, attention_weights
 
 class decoder(nn.Module):
-    def __init__(self, output_classes, H, W, D=512, hidden_units=512, seq_len=40, device='cpu'):
+    def __init__(self, output_classes, H, W, D=512, hidden_units=512, seq_len=40, device='cpu', early_stop=True, compact=False, beam_width=1, length_penalty=0.0, share_weights=False, stop_on_pad=False):
         super(decoder, self).__init__()
         '''
         output_classes: number of output classes for the one hot encoding of a word
@@ -69,32 +88,69 @@ class decoder(nn.Module):
         D: glimpse depth
         hidden_units: hidden units of encoder/decoder for LSTM
         seq_len: output sequence length T
+        early_stop: in eval mode, stop decoding once every sequence in the batch has emitted END
+        compact: with early_stop, drop finished sequences from the active batch at every step
+        beam_width: number of beams kept per image in eval mode, 1 for greedy search
+        length_penalty: exponent alpha of the length normalization score/length**alpha in beam search
+        share_weights: use one LSTM cell per layer for all time steps instead of seq_len+1 cells
+        stop_on_pad: also finish a sequence on PAD, faster for models trained on targets with PAD after the word
+        but a PAD emitted inside a word then cuts the word, so results may differ from full decoding
         '''
+        num_cells = 1 if share_weights else seq_len+1
         self.linear1 = nn.Linear(output_classes, hidden_units)
-        self.lstmcell1 = [nn.LSTMCell(hidden_units, hidden_units) for i in range(seq_len+1)]
-        self.lstmcell2 = [nn.LSTMCell(hidden_units, hidden_units) for i in range(seq_len+1)]
+        self.lstmcell1 = [nn.LSTMCell(hidden_units, hidden_units) for i in range(num_cells)]
+        self.lstmcell2 = [nn.LSTMCell(hidden_units, hidden_units) for i in range(num_cells)]
         self.attention = attention(hidden_units, H, W, D)
         self.linear2 = nn.Linear(hidden_units+D, output_classes)
         self.softmax = nn.LogSoftmax(dim=1)
         self.seq_len = seq_len
         self.START_TOKEN = output_classes - 3 # Same as END TOKEN
+        self.PAD_TOKEN = output_classes - 2 # svt, iiit5k, syn90k and synthtext targets have PAD after the word and END last
         self.output_classes = output_classes
         self.hidden_units = hidden_units
         self.device = device
+        self.early_stop = early_stop
+        self.compact = compact
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+        self.share_weights = share_weights
+        self.stop_on_pad = stop_on_pad
 
         self.lstmcell1 = torch.nn.ModuleList(self.lstmcell1)
         self.lstmcell2 = torch.nn.ModuleList(self.lstmcell2)
 
-    def forward(self,hw,y,V):
+    def cell_index(self, t):
+        '''
+        t: decoding time step
+        Output: index of the LSTM cells used at step t, all steps use cell 0 with share_weights
+        '''
+        return 0 if self.share_weights else t
+
+    def embed(self, index):
+        '''
+        index: token indices [batch]
+        Output: linear1 applied to the one-hot encoding of index, computed as a column lookup [batch, hidden_units]
+        '''
+        return self.linear1.weight.t()[index] + self.linear1.bias
+
+    def forward(self,hw,y,V,mask=None,return_attention=True):
         '''
         hw: embedded feature from encoder [batch, hidden_units]
-        y: ground truth label one hot encoder [batch, seq, output_classes]
+        y: ground truth label indices [batch, seq]
         V: feature map for backbone network [batch, D, H, W]
+        mask: optional bool mask of the valid feature map columns [batch, W]
+        return_attention: keep the attention weights of every step, otherwise None is returned for them
         '''
+        if not self.training and self.beam_width > 1:
+            return self.beam_search(hw, V, mask, return_attention)
+        if not self.training and self.early_stop:
+            return self.greedy_decode(hw, V, mask, return_attention)
+
         outputs = []
         attention_weights = []
         batch_size = hw.shape[0]
-        y_onehot = torch.zeros(batch_size, self.output_classes).to(self.device)
+        V_proj = self.attention.project(V) # [batch, D, H, W], shared by all time steps
+        start = torch.full((batch_size,), self.START_TOKEN, dtype=torch.long).to(self.device)
         for t in range(self.seq_len + 1):
             if t == 0:
                 inputs_y = hw # size [batch, hidden_units]
@@ -105,38 +161,186 @@ class decoder(nn.Module):
                 hx_2 = torch.zeros(batch_size, self.hidden_units).to(self.device) # initial h0_2
                 cx_2 = torch.zeros(batch_size, self.hidden_units).to(self.device) # initial c0_2
             elif t == 1:
-                y_onehot.zero_()
-                y_onehot[:,self.START_TOKEN] = 1.0
-                inputs_y = y_onehot
-                inputs_y = self.linear1(inputs_y) # [batch, hidden_units]
+                inputs_y = self.embed(start) # [batch, hidden_units]
             else:
                 if self.training:
-                    inputs_y = y[:,t-2,:] # [batch, output_classes]
+                    index = y[:,t-2] # [batch]
                 else:
-                    # greedy search for now - beam search to be implemented!
+                    # greedy search
                     index = torch.argmax(outputs[t-1], dim=-1) # [batch]
-                    index = index.unsqueeze(1) # [batch, 1]
-                    y_onehot.zero_()
-                    inputs_y = y_onehot.scatter_(1, index, 1) # [batch, output_classes]
 
-                inputs_y = self.linear1(inputs_y) # [batch, hidden_units_encoder]
+                inputs_y = self.embed(index) # [batch, hidden_units_encoder]
 
             # LSTM cells combined with attention and fusion layer
-            hx_1, cx_1 = self.lstmcell1[t](inputs_y, (hx_1,cx_1))
-            hx_2, cx_2 = self.lstmcell2[t](hx_1, (hx_2,cx_2))
-            glimpse, att_weights = self.attention(hx_2, V) # [batch, D], [batch, 1, H, W]
+            hx_1, cx_1 = self.lstmcell1[self.cell_index(t)](inputs_y, (hx_1,cx_1))
+            hx_2, cx_2 = self.lstmcell2[self.cell_index(t)](hx_1, (hx_2,cx_2))
+            glimpse, att_weights = self.attention(hx_2, V, V_proj, mask) # [batch, D], [batch, 1, H, W]
             combine = torch.cat((hx_2,glimpse), dim=1) # [batch, hidden_units_decoder+D]
             out = self.linear2(combine) # [batch, output_classes]
             out = self.softmax(out) # [batch, output_classes]
             outputs.append(out)
-            attention_weights.append(att_weights)
+            if return_attention:
+                attention_weights.append(att_weights)
 
         outputs = outputs[1:] # [seq_len, batch, output_classes]
-        attention_weights = attention_weights[1:] # [seq_len, batch, 1, H, W]
         outputs = torch.stack(outputs) # [seq_len, batch, output_classes]
         outputs = outputs.permute(1,0,2) # [batch, seq_len, output_classes]
-        attention_weights = torch.stack(attention_weights) # [seq_len, batch, 1, H, W]
-        attention_weights = attention_weights.permute(1,0,2,3,4) # [batch, seq_len, 1, H, W]
+        if return_attention:
+            attention_weights = attention_weights[1:] # [seq_len, batch, 1, H, W]
+            attention_weights = torch.stack(attention_weights) # [seq_len, batch, 1, H, W]
+            attention_weights = attention_weights.permute(1,0,2,3,4) # [batch, seq_len, 1, H, W]
+        else:
+            attention_weights = None
+
+        return outputs, attention_weights
+
+    def greedy_decode(self, hw, V, mask=None, return_attention=True):
+        '''
+        Greedy decoding with early exit once every sequence has emitted END, or PAD with stop_on_pad,
+        models trained on targets with PAD after the word only emit END at the last step.
+        hw: embedded feature from encoder [batch, hidden_units]
+        V: feature map for backbone network [batch, D, H, W]
+        mask: optional bool mask of the valid feature map columns [batch, W]
+        return_attention: keep the attention weights of every step, otherwise None is returned for them
+        Steps after the end are padded with a one-hot END log-probability and zero attention,
+        so outputs keep the [batch, seq_len, output_classes] shape of forward().
+        '''
+        batch_size, _, H, W = V.shape
+        V_proj = self.attention.project(V) # [batch, D, H, W], shared by all time steps
+        outputs = torch.full((batch_size, self.seq_len, self.output_classes), float('-inf')).to(self.device)
+        outputs[:,:,self.START_TOKEN] = 0.0 # padding predicts END with probability 1
+        attention_weights = torch.zeros(batch_size, self.seq_len, 1, H, W).to(self.device) if return_attention else None
+        active = torch.arange(batch_size).to(self.device) # batch rows still being decoded
+        finished = torch.zeros(batch_size, dtype=torch.bool).to(self.device)
+        index = torch.full((batch_size,), self.START_TOKEN, dtype=torch.long).to(self.device)
+        hx_1 = torch.zeros(batch_size, self.hidden_units).to(self.device)
+        cx_1 = torch.zeros(batch_size, self.hidden_units).to(self.device)
+        hx_2 = torch.zeros(batch_size, self.hidden_units).to(self.device)
+        cx_2 = torch.zeros(batch_size, self.hidden_units).to(self.device)
+        for t in range(self.seq_len + 1):
+            if t == 0:
+                inputs_y = hw # size [batch, hidden_units]
+            else:
+                inputs_y = self.embed(index) # [batch, hidden_units], index starts as START
+
+            hx_1, cx_1 = self.lstmcell1[self.cell_index(t)](inputs_y, (hx_1,cx_1))
+            hx_2, cx_2 = self.lstmcell2[self.cell_index(t)](hx_1, (hx_2,cx_2))
+            if t == 0:
+                continue # the output of the holistic feature step is never used
+            glimpse, att_weights = self.attention(hx_2, V, V_proj, mask) # [active, D], [active, 1, H, W]
+            out = self.softmax(self.linear2(torch.cat((hx_2,glimpse), dim=1))).float() # [active, output_classes]
+            att_weights = att_weights.float() # the float32 buffers also take the half precision results of autocast
+            index = torch.argmax(out, dim=-1) # [active]
+            is_end = index == self.START_TOKEN
+            if self.stop_on_pad:
+                is_end |= index == self.PAD_TOKEN
+            if self.compact:
+                outputs[active,t-1] = out
+                if return_attention:
+                    attention_weights[active,t-1] = att_weights
+                keep = ~is_end
+                if not bool(keep.any()):
+                    break
+                if not bool(keep.all()):
+                    # remove finished rows so later steps only process unfinished sequences
+                    active = active[keep]
+                    index = index[keep]
+                    hx_1, cx_1, hx_2, cx_2 = hx_1[keep], cx_1[keep], hx_2[keep], cx_2[keep]
+                    V, V_proj = V[keep], V_proj[keep]
+                    if mask is not None:
+                        mask = mask[keep]
+            else:
+                rows = ~finished # rows that already ended keep their padding
+                outputs[rows,t-1] = out[rows]
+                if return_attention:
+                    attention_weights[rows,t-1] = att_weights[rows]
+                finished |= is_end
+                if bool(finished.all()):
+                    break
+
+        return outputs, attention_weights
+
+    def beam_search(self, hw, V, mask=None, return_attention=True):
+        '''
+        Beam search where all beams of all images run through the LSTM cells and attention
+        as one [batch*beam_width] batch, stopping once every beam has emitted END, or PAD with stop_on_pad.
+        hw: embedded feature from encoder [batch, hidden_units]
+        V: feature map for backbone network [batch, D, H, W]
+        mask: optional bool mask of the valid feature map columns [batch, W]
+        return_attention: keep the attention weights of every step, otherwise None is returned for them
+        outputs hold, for the best hypothesis of each image, the log-probability of the token
+        chosen at every step and -inf for all other classes, so outputs.max(2) gives the decoded
+        indices and their log-probabilities. Steps after the end are padded as in greedy_decode.
+        '''
+        K = self.beam_width
+        C = self.output_classes
+        END = self.START_TOKEN
+        batch_size, _, H, W = V.shape
+        V_proj = self.attention.project(V) # [batch, D, H, W], shared by all beams and time steps
+        # the holistic feature step is identical for every beam, run it once per image
+        zeros = torch.zeros(batch_size, self.hidden_units).to(self.device)
+        hx_1, cx_1 = self.lstmcell1[0](hw, (zeros,zeros))
+        hx_2, cx_2 = self.lstmcell2[0](hx_1, (zeros,zeros))
+        hx_1, cx_1, hx_2, cx_2 = [state.repeat_interleave(K, dim=0) for state in (hx_1, cx_1, hx_2, cx_2)] # [batch*K, hidden_units]
+        scores = torch.full((batch_size, K), float('-inf')).to(self.device)
+        scores[:,0] = 0.0 # all beams start from START, keep a single copy
+        scores = scores.view(-1) # [batch*K] summed log-probability of every hypothesis
+        lengths = torch.zeros(batch_size*K).to(self.device) # tokens emitted including END
+        finished = torch.zeros(batch_size*K, dtype=torch.bool).to(self.device)
+        index = torch.full((batch_size*K,), END, dtype=torch.long).to(self.device) # START has the same id as END
+        offset = (torch.arange(batch_size)*K).unsqueeze(1).to(self.device) # [batch, 1] first row of each image
+        tokens, token_scores, att_history, backpointers = [], [], [], []
+        for t in range(1, self.seq_len + 1):
+            inputs_y = self.embed(index) # [batch*K, hidden_units]
+            hx_1, cx_1 = self.lstmcell1[self.cell_index(t)](inputs_y, (hx_1,cx_1))
+            hx_2, cx_2 = self.lstmcell2[self.cell_index(t)](hx_1, (hx_2,cx_2))
+            glimpse, att_weights = self.attention(hx_2, V, V_proj, mask) # [batch*K, D], [batch*K, 1, H, W]
+            out = self.softmax(self.linear2(torch.cat((hx_2,glimpse), dim=1))).float() # [batch*K, C], scores accumulate in float32 under autocast
+            att_weights = att_weights.float()
+            # finished hypotheses can only be extended with END at no cost
+            out = out.masked_fill(finished.unsqueeze(1), float('-inf'))
+            out[:,END] = out[:,END].masked_fill(finished, 0.0)
+            candidates = scores.unsqueeze(1) + out # [batch*K, C]
+            candidate_lengths = lengths + (~finished).float() # [batch*K]
+            normalized = candidates / candidate_lengths.unsqueeze(1) ** self.length_penalty
+            _, best = normalized.view(batch_size, K*C).topk(K, dim=1) # [batch, K]
+            source = (torch.div(best, C, rounding_mode='floor') + offset).view(-1) # [batch*K] previous rows
+            index = (best % C).view(-1) # [batch*K]
+            scores = candidates.view(batch_size, K*C).gather(1, best).view(-1)
+            lengths = candidate_lengths[source]
+            if return_attention:
+                att_history.append(att_weights[source].masked_fill(finished[source].view(-1,1,1,1), 0.0))
+            token_scores.append(out[source, index])
+            finished = finished[source] | (index == END)
+            if self.stop_on_pad:
+                finished |= index == self.PAD_TOKEN
+            hx_1, cx_1, hx_2, cx_2 = hx_1[source], cx_1[source], hx_2[source], cx_2[source]
+            tokens.append(index)
+            backpointers.append(source)
+            if bool(finished.all()):
+                break
+
+        # backtrack the best hypothesis of every image
+        best = (scores / lengths ** self.length_penalty).view(batch_size, K).argmax(dim=1) # [batch]
+        row = best + offset.squeeze(1) # [batch]
+        best_tokens, best_scores, best_att = [], [], []
+        for t in reversed(range(len(tokens))):
+            best_tokens.append(tokens[t][row])
+            best_scores.append(token_scores[t][row])
+            if return_attention:
+                best_att.append(att_history[t][row])
+            row = backpointers[t][row]
+        steps = len(tokens)
+        best_tokens = torch.stack(best_tokens[::-1], dim=1) # [batch, steps]
+        best_scores = torch.stack(best_scores[::-1], dim=1) # [batch, steps]
+        outputs = torch.full((batch_size, self.seq_len, C), float('-inf')).to(self.device)
+        outputs[:,:,END] = 0.0 # padding predicts END with probability 1
+        outputs[:,:steps].fill_(float('-inf')).scatter_(2, best_tokens.unsqueeze(2), best_scores.unsqueeze(2))
+        if return_attention:
+            attention_weights = torch.zeros(batch_size, self.seq_len, 1, H, W).to(self.device)
+            attention_weights[:,:steps] = torch.stack(best_att[::-1], dim=1) # [batch, steps, 1, H, W]
+        else:
+            attention_weights = None
 
         return outputs, attention_weights
 
@@ -171,8 +375,39 @@ if __name__ == '__main__':
     print("Glimpse size is:", glimpse.shape)
     print("Attention weight size is:", attention_weights.shape)
 
-    label = torch.randn(batch_size, seq_len, output_classes)
+    label = torch.randint(0, output_classes, (batch_size, seq_len))
     decoder_model = decoder(output_classes, Height, Width, Channel, hidden_units, seq_len)
     outputs, attention_weights = decoder_model(hw, label, feature_map)
     print("Output size is:", outputs.shape)
-    print("Attention_weights size is:", attention_weights.shape)
\ No newline at end of file
+    print("Attention_weights size is:", attention_weights.shape)
+
+    decoder_model = decoder_model.eval()
+    with torch.no_grad():
+        decoder_model.early_stop = False
+        outputs_full, _ = decoder_model(hw, label, feature_map)
+        decoder_model.early_stop = True
+        outputs_early, _ = decoder_model(hw, label, feature_map)
+        decoder_model.compact = True
+        outputs_compact, _ = decoder_model(hw, label, feature_map)
+    print("Early stop output size is:", outputs_early.shape)
+    decoded = outputs_early.max(2)[1] # [batch, seq_len]
+    before_end = torch.cumsum((decoded == decoder_model.START_TOKEN).long(), dim=1) == 0
+    print("Early stop matches full decoding:", torch.equal(outputs_full.max(2)[1][before_end], decoded[before_end]))
+    print("Compact matches early stop:", torch.equal(outputs_early.max(2)[1], outputs_compact.max(2)[1]))
+
+    # a PAD-terminated batch: the output layer always predicts PAD, as for a model trained on svt targets
+    steps = []
+    for cell in decoder_model.lstmcell1:
+        cell.register_forward_hook(lambda module, inputs, output: steps.append(1))
+    with torch.no_grad():
+        decoder_model.linear2.bias[decoder_model.PAD_TOKEN] = 1e4
+        decoder_model.compact = False
+        for stop_on_pad in (False, True):
+            decoder_model.stop_on_pad = stop_on_pad
+            steps.clear()
+            outputs_pad, _ = decoder_model(hw, label, feature_map)
+            print("stop_on_pad={} decoding steps on a PAD-terminated batch:".format(stop_on_pad), len(steps))
+            if stop_on_pad:
+                assert len(steps) < seq_len + 1, "stop_on_pad did not stop decoding early"
+            else:
+                assert len(steps) == seq_len + 1
\ No newline at end of file
@@ -9,24 +9,33 @@ __all__ = ['encoder']
 class encoder(nn.Module):
     def __init__(self, H, C, hidden_units=512, layers=2, keep_prob=1.0, device='cpu'):
         super(encoder, self).__init__()
-        self.maxpool = nn.MaxPool2d(kernel_size=(H,1), stride=1)
+        '''
+        H: feature map height, the vertical max pooling adapts to the height of its input
+        C: feature map depth
+        hidden_units: hidden units of LSTM
+        layers: LSTM layers
+        keep_prob: dropout of LSTM
+        '''
         self.lstm = nn.LSTM(input_size=C, hidden_size=hidden_units, num_layers=layers, batch_first=True, dropout=keep_prob)
         self.layers = layers
         self.hidden_units = hidden_units
         self.device = device
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        '''
+        x: feature map [batch, C, H, W]
+        lengths: optional number of valid (not padded) columns of every sample [batch],
+        the LSTM then stops at the last valid column of each sample
+        '''
         self.lstm.flatten_parameters()
-        # x is feature map in [batch, C, H, W]
         # Initialize hidden state with zeros
         h_0 = torch.zeros(self.layers*1, x.size(0), self.hidden_units).to(self.device)
         # Initialize cell state
         c_0 = torch.zeros(self.layers*1, x.size(0), self.hidden_units).to(self.device)
-        x = self.maxpool(x) # [batch, C, 1, W]
-        x = torch.squeeze(x) # [batch, C, W]
-        if len(x.size()) == 2: # [C, W]
-            x = x.unsqueeze(0) # [batch, C, W]
+        x = torch.max(x, dim=2)[0] # max pooling over the whole height [batch, C, W], W may differ per batch
         x = x.permute(0,2,1) # [batch, W, C]
+        if lengths is not None:
+            x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
         _, (h, _) = self.lstm(x, (h_0, c_0)) # h with shape [layers*1, batch, hidden_uints]
 
         return h[-1] # shape [batch, hidden_units]
@@ -44,4 +53,10 @@ if __name__ == '__main__':
     encoder_model = encoder(Height, Channel, hidden_units=512, layers=2, keep_prob=1.0)
     output_encoder = encoder_model(input_feature)
 
-    print("Output feature of encoder size is:",output_encoder.shape) # (batch, hidden_units)
\ No newline at end of file
+    print("Output feature of encoder size is:",output_encoder.shape) # (batch, hidden_units)
+
+    encoder_model = encoder_model.eval()
+    lengths = torch.randint(1, Width+1, (batch_size,))
+    output_packed = encoder_model(input_feature, lengths)
+    output_cut = torch.cat([encoder_model(input_feature[i:i+1,:,:,:lengths[i]]) for i in range(batch_size)])
+    print("Packed encoder matches cropped inputs:", torch.allclose(output_packed, output_cut, atol=1e-5))
\ No newline at end of file
@@ -0,0 +1,112 @@
+'''
+This code is to construct a TorchScript/ONNX exportable version of SAR - backbone+encoder+greedy decoder with early stopping.
+'''
+import torch
+import torch.nn as nn
+from typing import Tuple
+
+__all__ = ['sar_greedy']
+
+class sar_greedy(nn.Module):
+    def __init__(self, model):
+        super(sar_greedy, self).__init__()
+        '''
+        model: trained sar in eval mode, its modules and weights are shared, not copied
+        The per-step LSTM cells of the decoder are stacked into [num_cells, ...] tensors so the time step
+        can index them inside a scripted loop, and the attention is computed without the beam and mask
+        options of the eager module. Outputs match decoder.greedy_decode.
+        '''
+        decoder = model.decoder_model
+        self.backbone = model.backbone
+        self.lstm = model.encoder_model.lstm
+        self.conv1 = decoder.attention.conv1
+        self.conv2 = decoder.attention.conv2
+        self.conv3 = decoder.attention.conv3
+        self.linear1 = decoder.linear1
+        self.linear2 = decoder.linear2
+        for layer, cells in (('1', decoder.lstmcell1), ('2', decoder.lstmcell2)):
+            self.register_buffer('w_ih' + layer, torch.stack([cell.weight_ih.detach() for cell in cells]))
+            self.register_buffer('w_hh' + layer, torch.stack([cell.weight_hh.detach() for cell in cells]))
+            self.register_buffer('b' + layer, torch.stack([(cell.bias_ih + cell.bias_hh).detach() for cell in cells]))
+        self.num_cells = len(decoder.lstmcell1)
+        self.layers = model.encoder_model.layers
+        self.hidden_units = decoder.hidden_units
+        self.seq_len = decoder.seq_len
+        self.output_classes = decoder.output_classes
+        self.END_TOKEN = decoder.START_TOKEN
+        self.PAD_TOKEN = decoder.PAD_TOKEN
+        self.stop_on_pad = decoder.stop_on_pad
+
+    def lstm_cell(self, x, h, c, w_ih, w_hh, b):
+        # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        gates = torch.matmul(x, w_ih.t()) + torch.matmul(h, w_hh.t()) + b # [batch, 4*hidden_units]
+        i, f, g, o = gates.chunk(4, 1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return h, c
+
+    def forward(self, x):
+        '''
+        x: input images [batch, channel, height, width] normalized to [-1,1]
+        Output: log-probabilities [batch, seq_len, output_classes], steps after the end are padded with END
+        '''
+        V = self.backbone(x) # [batch, D, H, W]
+        batch_size = V.size(0)
+        D = V.size(1)
+        H = V.size(2)
+        W = V.size(3)
+        # encoder
+        h_0 = torch.zeros(self.layers, batch_size, self.hidden_units, dtype=V.dtype, device=V.device)
+        feature = torch.max(V, dim=2)[0].permute(0,2,1) # [batch, W, D]
+        _, (h, _) = self.lstm(feature, (h_0, h_0))
+        hw = h[-1] # [batch, hidden_units]
+        # decoder
+        V_proj = self.conv2(V) # [batch, D, H, W]
+        V_flat = V.reshape(batch_size, D, H*W).transpose(1,2) # [batch, H*W, D]
+        zeros = torch.zeros(batch_size, self.hidden_units, dtype=V.dtype, device=V.device)
+        hx_1, cx_1 = self.lstm_cell(hw, zeros, zeros, self.w_ih1[0], self.w_hh1[0], self.b1[0])
+        hx_2, cx_2 = self.lstm_cell(hx_1, zeros, zeros, self.w_ih2[0], self.w_hh2[0], self.b2[0])
+        padding = torch.full((1, self.output_classes), float('-inf'), dtype=V.dtype, device=V.device)
+        padding[:,self.END_TOKEN] = 0.0 # padding predicts END with probability 1
+        outputs = padding.unsqueeze(1).repeat(batch_size, self.seq_len, 1) # [batch, seq_len, output_classes]
+        index = torch.full((batch_size,), self.END_TOKEN, dtype=torch.long, device=V.device) # START has the same id as END
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=V.device)
+        t = 1
+        done = False
+        while t <= self.seq_len and not done:
+            k = min(t, self.num_cells - 1)
+            inputs_y = self.linear1.weight.t()[index] + self.linear1.bias # [batch, hidden_units]
+            hx_1, cx_1 = self.lstm_cell(inputs_y, hx_1, cx_1, self.w_ih1[k], self.w_hh1[k], self.b1[k])
+            hx_2, cx_2 = self.lstm_cell(hx_1, hx_2, cx_2, self.w_ih2[k], self.w_hh2[k], self.b2[k])
+            # attention
+            h_proj = self.conv1(hx_2.unsqueeze(2).unsqueeze(3)) # [batch, D, 1, 1]
+            score = self.conv3(torch.tanh(V_proj + h_proj)).reshape(batch_size, 1, H*W) # [batch, 1, H*W]
+            glimpse = torch.bmm(torch.softmax(score, dim=-1), V_flat).squeeze(1) # [batch, D]
+            out = torch.log_softmax(self.linear2(torch.cat((hx_2, glimpse), dim=1)), dim=1) # [batch, output_classes]
+            index = torch.argmax(out, dim=-1) # [batch]
+            outputs[:,t-1] = torch.where(finished.unsqueeze(1), padding, out)
+            finished = finished | (index == self.END_TOKEN)
+            if self.stop_on_pad:
+                finished = finished | (index == self.PAD_TOKEN)
+            done = bool(finished.all())
+            t += 1
+
+        return outputs
+
+# unit test
+if __name__ == '__main__':
+    '''
+    Need to run from the repository root:
+    python -m models.export
+    '''
+    from .sar import sar
+
+    torch.manual_seed(0)
+    x = torch.rand(2, 3, 48, 64) * 2 - 1
+    for share_weights in (False, True):
+        model = sar(3, 12, 8, 512, 97, 512, 2, 1.0, 40, share_weights=share_weights).eval()
+        with torch.no_grad():
+            predict_eager, _, _, _ = model(x, 0)
+            scripted = torch.jit.script(sar_greedy(model))
+            predict_script = scripted(x)
+        print("share_weights={} scripted matches eager:".format(share_weights), torch.allclose(predict_eager, predict_script, atol=1e-4))
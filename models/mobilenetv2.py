@@ -1,4 +1,5 @@
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 def _make_divisible(v, divisor, min_value=None):
     """
@@ -31,6 +32,12 @@ class ConvBNReLU(nn.Sequential):
             nn.ReLU6(inplace=True)
         )
 
+    def fuse(self):
+        # fold the batch norm into the convolution, only valid in eval mode
+        if isinstance(self[1], nn.BatchNorm2d):
+            self[0] = fuse_conv_bn_eval(self[0], self[1])
+            self[1] = nn.Identity()
+
 
 class InvertedResidual(nn.Module):
     def __init__(self, inp, oup, stride, expand_ratio, norm_layer=None, sw_normal=True):
@@ -57,6 +64,15 @@ class InvertedResidual(nn.Module):
         ])
         self.conv = nn.Sequential(*layers)
 
+    def fuse(self):
+        # fold the batch norm of the pw-linear layer into its convolution, only valid in eval mode
+        for m in self.conv:
+            if isinstance(m, ConvBNReLU):
+                m.fuse()
+        if isinstance(self.conv[-1], nn.BatchNorm2d):
+            self.conv[-2] = fuse_conv_bn_eval(self.conv[-2], self.conv[-1])
+            self.conv[-1] = nn.Identity()
+
     def forward(self, x):
         if self.use_res_connect:
             return x + self.conv(x)
@@ -159,6 +175,15 @@ class MobileNetV2(nn.Module):
                 nn.init.normal_(m.weight, 0, 0.01)
                 nn.init.zeros_(m.bias)
 
+    def fuse(self):
+        """
+        Fold every BatchNorm into the preceding convolution for inference, the model must be in eval mode
+        """
+        assert not self.training, "fuse() requires eval mode"
+        for m in self.features:
+            m.fuse()
+        return self
+
     def _forward_impl(self, x):
         # This exists since TorchScript doesn't support inheritance, so the superclass method
         # (this one) needs to have a name other than `forward` that can be accessed in a subclass
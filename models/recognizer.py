@@ -0,0 +1,101 @@
+'''
+This code is to construct an inference engine around a trained SAR checkpoint.
+'''
+import math
+import torch
+from .sar import sar
+from dataset.dataset import dictionary_generator, preprocess_image, normalize_batch
+from utils.dataproc import end_cut, word_log_prob
+from utils.quantization import quantize_decoder, quantize_backbone
+
+__all__ = ['Recognizer']
+
+class Recognizer(object):
+    def __init__(self, model_path, device='cpu', height=48, width=64, batch_size=32, beam_width=1, length_penalty=0.0, share_weights=False, compact=False, stop_on_pad=False, fuse=True, int8=False, calibration=None):
+        '''
+        model_path: state dict of sar saved by train.py, loaded strictly
+        device: device to run on
+        height: input height to model
+        width: input width to model
+        batch_size: max images per forward pass in recognize()
+        beam_width: beam width of the decoder, 1 for greedy search
+        length_penalty: length normalization exponent for beam search
+        share_weights: the checkpoint has a weight-shared decoder
+        compact: drop finished sequences from the active batch of the greedy decoder
+        stop_on_pad: also stop decoding a sequence at PAD
+        fuse: fold the batch norms of the MobileNetV2 backbone into its convolutions
+        int8: dynamic int8 quantization of the decoder LSTM cells and output layer, CPU only
+        calibration: with int8, iterable of input batches [batch, channel, height, width] normalized to [-1,1]
+        to calibrate the static int8 quantization of the backbone, None keeps the backbone in float
+        '''
+        self.device = torch.device(device)
+        self.height = height
+        self.width = width
+        self.batch_size = batch_size
+        self.voc, self.char2id, self.id2char = dictionary_generator()
+        self.model = sar(3, height // 4, width // 8, 512, len(self.voc), 512, 2, 1.0, 40, self.device, beam_width, length_penalty, share_weights, compact, stop_on_pad)
+        self.model.load_state_dict(torch.load(model_path, map_location=lambda storage, loc: storage))
+        self.model = self.model.to(self.device).eval()
+        if int8:
+            assert self.device.type == 'cpu', "int8 quantization is only supported on CPU"
+            self.model = quantize_decoder(self.model)
+        if int8 and calibration is not None:
+            self.model = quantize_backbone(self.model, calibration)
+        elif fuse:
+            self.model.backbone.fuse()
+
+    @torch.inference_mode()
+    def predict(self, x, return_attention=False):
+        '''
+        x: input images [batch, channel, height, width] normalized to [-1,1]
+        return_attention: also return the attention weights
+        Output: log-probabilities [batch, seq_len, output_classes], attention weights [batch, seq_len, 1, H, W] or None
+        '''
+        predict, att_weights, _, _ = self.model(x.to(self.device), 0, return_attention=return_attention)
+        return predict, att_weights
+
+    def decode(self, predict):
+        '''
+        predict: log-probabilities [batch, seq_len, output_classes] from predict()
+        Output: list of (text, log-probability of the decoded word)
+        '''
+        pred_choice = predict.max(2)[1].cpu().numpy() # [batch, seq_len]
+        log_prob = word_log_prob(predict, self.char2id['END']).tolist() # [batch]
+        return [(end_cut(indices, self.char2id, self.id2char), lp) for indices, lp in zip(pred_choice, log_prob)]
+
+    def recognize(self, images):
+        '''
+        images: list of uint8 images [H, W, C] in BGR order, e.g. from cv2.imread
+        Output: list of (text, confidence) where confidence is the probability of the decoded word
+        '''
+        results = []
+        for start in range(0, len(images), self.batch_size):
+            x = normalize_batch(torch.stack([preprocess_image(IMG, self.height, self.width) for IMG in images[start:start+self.batch_size]]), self.device)
+            predict, _ = self.predict(x)
+            results += [(text, math.exp(lp)) for text, lp in self.decode(predict)]
+        return results
+
+# unit test
+if __name__ == '__main__':
+    '''
+    Need to run from the repository root:
+    python -m models.recognizer
+    '''
+    import os
+    import tempfile
+    import numpy as np
+
+    torch.manual_seed(0)
+    voc, char2id, id2char = dictionary_generator()
+    model = sar(3, 12, 8, 512, len(voc), 512, 2, 1.0, 40).eval()
+    with tempfile.TemporaryDirectory() as folder:
+        model_path = os.path.join(folder, 'model_best.pth')
+        torch.save(model.state_dict(), model_path)
+        recognizer = Recognizer(model_path)
+    images = [np.random.randint(0, 255, (32, 100, 3)).astype(np.uint8) for _ in range(3)]
+    x = normalize_batch(torch.stack([preprocess_image(IMG, 48, 64) for IMG in images]), 'cpu')
+    with torch.no_grad():
+        predict_eager, _, _, _ = model(x, 0)
+    predict_fused, _ = recognizer.predict(x)
+    print("Fused model matches eager model:", torch.allclose(predict_eager.exp(), predict_fused.exp(), atol=1e-4))
+    print("Recognized:", recognizer.recognize(images))
@@ -12,7 +12,7 @@ from .decoder import decoder
 __all__ = ['sar']
 
 class sar(nn.Module):
-    def __init__(self, channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units=512, layers=2, keep_prob=1.0, seq_len=40, device='cpu'):
+    def __init__(self, channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units=512, layers=2, keep_prob=1.0, seq_len=40, device='cpu', beam_width=1, length_penalty=0.0, share_weights=False, compact=False, stop_on_pad=False):
         super(sar, self).__init__()
         '''
         channel: channel of input image
@@ -23,12 +23,17 @@ class sar(nn.Module):
         layers: layers for both LSTM encoder and decoder, should be set to 2
         keep_prob: keep_prob probability dropout for LSTM encoder
         seq_len: decoding sequence length
+        beam_width: beam width of the decoder in eval mode, 1 for greedy search
+        length_penalty: length normalization exponent for beam search
+        share_weights: share the decoder LSTM cells across time steps
+        compact: drop finished sequences from the active batch of the greedy decoder
+        stop_on_pad: also finish a sequence on PAD, svt, iiit5k, syn90k and synthtext targets end the word with PAD
         '''
         # self.backbone = backbone(channel)
         # self.backbone = shufflenet_v2_x1_0()
         self.backbone = MobileNetV2()
         self.encoder_model = encoder(feature_height, 512, hidden_units, layers, keep_prob, device)
-        self.decoder_model = decoder(output_classes, feature_height, feature_width, 512, hidden_units, seq_len, device)
+        self.decoder_model = decoder(output_classes, feature_height, feature_width, 512, hidden_units, seq_len, device, beam_width=beam_width, length_penalty=length_penalty, share_weights=share_weights, compact=compact, stop_on_pad=stop_on_pad)
         self.embedding_dim = embedding_dim
         self.output_classes = output_classes
         self.hidden_units = hidden_units
@@ -36,15 +41,25 @@ class sar(nn.Module):
         self.keep_prob = keep_prob
         self.seq_len = seq_len
         self.device = device
+        self.width_stride = 8 # width downsampling of the MobileNetV2 backbone, feature_width = width // 8
 
-    def forward(self,x,y):
+    def forward(self,x,y,width=None,return_attention=True):
         '''
         x: input images [batch, channel, height, width]
-        y: output labels [batch, seq_len, output_classes]
+        y: output label indices [batch, seq_len]
+        width: optional width in pixels of the valid (not padded) part of every image [batch],
+        padded feature columns are then skipped by the encoder and get no attention
+        return_attention: return the attention weights of every decoding step, otherwise None
         '''
         V = self.backbone(x) # (batch, feature_depth, feature_height, feature_width)
-        hw = self.encoder_model(V) # (batch, hidden_units)
-        outputs, attention_weights = self.decoder_model(hw, y, V) # [batch, seq_len, output_classes], [batch, seq_len, 1, feature_height, feature_width]
+        if width is None:
+            lengths, mask = None, None
+        else:
+            # the fixed stride, a ratio of the padded sizes is off when the batch width is not a multiple of it
+            lengths = torch.clamp((width + self.width_stride - 1) // self.width_stride, 1, V.size(3)) # valid feature columns [batch]
+            mask = torch.arange(V.size(3), device=V.device).unsqueeze(0) < lengths.unsqueeze(1) # [batch, feature_width]
+        hw = self.encoder_model(V, lengths) # (batch, hidden_units)
+        outputs, attention_weights = self.decoder_model(hw, y, V, mask, return_attention) # [batch, seq_len, output_classes], [batch, seq_len, 1, feature_height, feature_width]
 
         return outputs, attention_weights, V, hw
 
@@ -72,7 +87,7 @@ if __name__ == '__main__':
     feature_height = Height // 4
     feature_width = Width // 8
 
-    y = torch.randn(batch_size, seq_len, output_classes)
+    y = torch.randint(0, output_classes, (batch_size, seq_len))
     x = torch.randn(batch_size, Channel, Height, Width)
     print("Input image size is:", x.shape)
     print("Input label size is:", y.shape)
@@ -87,4 +102,11 @@ if __name__ == '__main__':
     print("Prediction size is:", predict2.shape)
     print("Attention weight size is:", att_weights2.shape)
 
-    print("Difference:", torch.sum(predict1-predict2))
\ No newline at end of file
+    print("Difference:", torch.sum(predict1-predict2))
+
+    width = torch.tensor([Width, Width // 2])
+    predict3, att_weights3, _, _ = model.eval()(x, y, width)
+    valid_columns = (Width // 2 + model.width_stride - 1) // model.width_stride # ceil of the valid width over the backbone stride
+    padded_attention = torch.sum(att_weights3[1,:,:,:,valid_columns:]).item()
+    print("Attention on padded columns:", padded_attention)
+    assert padded_attention == 0, "padded columns got attention"
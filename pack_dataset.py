@@ -0,0 +1,43 @@
+'''
+This code is to pack a dataset into pre-cropped, resized images for memory-mapped training.
+'''
+import os
+import argparse
+from torch.multiprocessing import freeze_support
+# internal package
+from dataset import dataset
+
+# main function:
+if __name__ == '__main__':
+    freeze_support()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--worker', type=int, default=4, help='number of packing processes')
+    parser.add_argument('--dataset', type=str, required=True, help="dataset path")
+    parser.add_argument('--dataset_type', type=str, default='svt', help="dataset type - svt|iiit5k|iiit5k2|syn90k|synthtext")
+    parser.add_argument('--output', type=str, required=True, help="output folder, train and test splits are packed into its train and test subfolders")
+
+    opt = parser.parse_args()
+    print(opt)
+
+    # same input size as train.py
+    Height = 48
+    Width = 160
+    seq_len = 40
+    dataset_path = opt.dataset
+    dataset_type = opt.dataset_type
+
+    # create dataset
+    print("Create dataset......")
+    if dataset_type == 'packed':
+        print("Not supported yet!")
+        exit(1)
+    # for iiit5k2 the random noise padding is frozen at packing time, the valid widths are packed with the images,
+    # and the ColorJitter of the train split is recorded in meta.json and applied again when the packed images are read
+    train_dataset, test_dataset = dataset.build_dataset(dataset_type, dataset_path, Height, Width, seq_len)
+
+    print("Packing {} training samples......".format(len(train_dataset)))
+    dataset.pack_dataset(train_dataset, os.path.join(opt.output, 'train'), opt.worker)
+    print("Packing {} testing samples......".format(len(test_dataset)))
+    dataset.pack_dataset(test_dataset, os.path.join(opt.output, 'test'), opt.worker)
+    print("Packing done!")
@@ -0,0 +1,75 @@
+'''
+This code is to compare the accuracy and latency of the float32 and int8 SAR models on a held-out set.
+'''
+import argparse
+import time
+import torch
+import torch.utils.data
+from torch.multiprocessing import freeze_support
+# internal package
+from dataset import dataset
+from dataset.dataset import dictionary_generator
+from models.recognizer import Recognizer
+from utils.dataproc import performance_evaluate
+from utils.quantization import model_size
+
+def evaluate(recognizer, dataloader, voc, char2id, id2char):
+    '''
+    recognizer: Recognizer to evaluate
+    dataloader: labelled test dataloader
+    Output: accuracy, average edit distance, images/sec of the model calls
+    '''
+    acc_list = []
+    ed_list = []
+    model_time = 0.0
+    for data in dataloader:
+        x = dataset.normalize_batch(data[0], 'cpu') # [batch_size, Channel, Height, Width]
+        target = data[1].numpy() # [batch_size, seq_len]
+        start_time = time.perf_counter()
+        predict, _ = recognizer.predict(x)
+        model_time += time.perf_counter() - start_time
+        pred_choice = predict.max(2)[1].cpu().numpy() # [batch_size, seq_len]
+        acc_list += performance_evaluate(pred_choice, target, voc, char2id, id2char, 'accuracy')[1]
+        ed_list += performance_evaluate(pred_choice, target, voc, char2id, id2char, 'editdistance')[1]
+    return sum(acc_list) / len(acc_list), sum(ed_list) / len(ed_list), len(acc_list) / model_time
+
+# main function:
+if __name__ == '__main__':
+    freeze_support()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=32, help='batch size')
+    parser.add_argument(
+        '--worker', type=int, default=4, help='number of data loading workers')
+    parser.add_argument('--model', type=str, required=True, help='model path')
+    parser.add_argument('--dataset', type=str, required=True, help="dataset path, the test split is evaluated")
+    parser.add_argument('--dataset_type', type=str, default='svt', help="dataset type - svt|iiit5k|iiit5k2|syn90k|synthtext|packed")
+    parser.add_argument('--width', type=int, default=160, help='input width the model was trained with')
+    parser.add_argument('--share_weights', action='store_true', help="the checkpoint has a weight-shared decoder")
+    parser.add_argument('--calibration_batches', type=int, default=10, help="training batches to calibrate the backbone quantization, 0 keeps the backbone in float")
+    parser.add_argument('--threads', type=int, default=0, help='number of CPU threads, 0 for the torch default')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    Height = 48
+    Width = opt.width
+    seq_len = 40
+    voc, char2id, id2char = dictionary_generator()
+
+    train_dataset, test_dataset = dataset.build_dataset(opt.dataset_type, opt.dataset, Height, Width, seq_len)
+    calibration_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=opt.batch, shuffle=True, num_workers=int(opt.worker))
+    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=opt.batch, shuffle=False, num_workers=int(opt.worker))
+    calibration = [dataset.normalize_batch(data[0], 'cpu') for _, data in zip(range(opt.calibration_batches), calibration_dataloader)] if opt.calibration_batches > 0 else None
+
+    recognizers = {
+        'fp32': Recognizer(opt.model, 'cpu', Height, Width, opt.batch, share_weights=opt.share_weights),
+        'int8': Recognizer(opt.model, 'cpu', Height, Width, opt.batch, share_weights=opt.share_weights, int8=True, calibration=calibration),
+    }
+
+    print("{:>6} {:>10} {:>14} {:>12} {:>10}".format('model', 'accuracy', 'edit distance', 'images/sec', 'size MB'))
+    for name, recognizer in recognizers.items():
+        accuracy, edit_distance, speed = evaluate(recognizer, test_dataloader, voc, char2id, id2char)
+        print("{:>6} {:>10.4f} {:>14.4f} {:>12.1f} {:>10.1f}".format(name, accuracy, edit_distance, speed, model_size(recognizer.model) / 2**20))
@@ -0,0 +1,53 @@
+'''
+This code is to run the recognition HTTP server with dynamic micro-batching.
+'''
+import os
+os.environ["CUDA_VISIBLE_DEVICES"] = "0" # set GPU id at the very begining
+import argparse
+import asyncio
+import torch
+# internal package
+from models.recognizer import Recognizer
+from utils.serving import recognition_server
+
+async def serve(server, host, port, unix_path):
+    listener = await server.start(host, port, unix_path)
+    print("Serving on", unix_path if unix_path is not None else "http://{}:{}".format(host, port))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.stop()
+
+# main function:
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='model path')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--unix', type=str, default='', help='listen on this Unix socket instead of host:port')
+    parser.add_argument('--max_batch', type=int, default=32, help='max images per batch')
+    parser.add_argument('--max_wait', type=float, default=5.0, help='max milliseconds the first image of a batch waits for more images')
+    parser.add_argument('--gpu', type=bool, default=False, help="GPU being used or not")
+    parser.add_argument('--beam', type=int, default=1, help="beam width for decoding, 1 for greedy search")
+    parser.add_argument('--length_penalty', type=float, default=0.0, help="length normalization exponent for beam search")
+    parser.add_argument('--share_weights', action='store_true', help="the checkpoint has a weight-shared decoder")
+    parser.add_argument('--stop_on_pad', action='store_true', help="also stop decoding a sequence at PAD, for models trained on targets with PAD after the word")
+    parser.add_argument('--compact', action='store_true', help="drop finished sequences from the decoding batch at every step")
+    parser.add_argument('--int8', action='store_true', help="int8 quantization of the decoder for CPU inference")
+    parser.add_argument('--threads', type=int, default=0, help='number of CPU threads, 0 for the torch default')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    device = torch.device("cuda" if opt.gpu and torch.cuda.is_available() else "cpu")
+    print("Device:", device)
+
+    recognizer = Recognizer(opt.model, device, 48, 64, opt.max_batch, opt.beam, opt.length_penalty, opt.share_weights, opt.compact, opt.stop_on_pad, int8=opt.int8)
+    server = recognition_server(recognizer, opt.max_batch, opt.max_wait / 1000)
+    try:
+        asyncio.run(serve(server, opt.host, opt.port, opt.unix if opt.unix != '' else None))
+    except KeyboardInterrupt:
+        pass
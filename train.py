@@ -3,7 +3,8 @@ THis is the main training code.
 '''
 import os
 import time
-os.environ["CUDA_VISIBLE_DEVICES"] = "0" # set GPU id at the very begining
+if 'LOCAL_RANK' not in os.environ: # torchrun selects one GPU per process by LOCAL_RANK
+    os.environ["CUDA_VISIBLE_DEVICES"] = "0" # set GPU id at the very begining
 import argparse
 import random
 import math
@@ -19,6 +20,11 @@ from dataset import dataset
 from dataset.dataset import dictionary_generator
 from models.sar import sar
 from utils.dataproc import performance_evaluate
+from utils.precision import autocast, grad_scaler, channels_last
+from utils.logger import train_logger
+from utils.distributed import is_distributed_launch, init_distributed, all_reduce_sum, broadcast_value, gather_values, cleanup
+from utils.checkpoint import checkpoint_writer, rng_state, set_rng_state
+from utils.prefetch import loader_options, prefetch_loader
 
 # main function:
 if __name__ == '__main__':
@@ -33,20 +39,35 @@ if __name__ == '__main__':
     parser.add_argument('--output', type=str, default='str', help='output folder name')
     parser.add_argument('--model', type=str, default='', help='model path')
     parser.add_argument('--dataset', type=str, required=True, help="dataset path")
-    parser.add_argument('--dataset_type', type=str, default='svt', help="dataset type - svt|iiit5k|syn90k|synthtext")
+    parser.add_argument('--dataset_type', type=str, default='svt', help="dataset type - svt|iiit5k|iiit5k2|syn90k|synthtext|packed")
     parser.add_argument('--gpu', type=bool, default=False, help="GPU being used or not")
     parser.add_argument('--metric', type=str, default='accuracy', help="evaluation metric - accuracy|editdistance")
+    parser.add_argument('--beam', type=int, default=1, help="beam width for validation decoding, 1 for greedy search")
+    parser.add_argument('--length_penalty', type=float, default=0.0, help="length normalization exponent for beam search")
+    parser.add_argument('--share_weights', action='store_true', help="share the decoder LSTM cells across time steps")
+    parser.add_argument('--stop_on_pad', action='store_true', help="also stop decoding a sequence at PAD, for models trained on targets with PAD after the word")
+    parser.add_argument('--compact', action='store_true', help="drop finished sequences from the decoding batch at every step")
+    parser.add_argument('--bucket', action='store_true', help="batch iiit5k2 images of similar width and pad each batch to its own max width")
+    parser.add_argument('--bucket_length', action='store_true', help="with --bucket, also bucket by label length")
+    parser.add_argument('--log_interval', type=int, default=50, help="training steps between two metric synchronizations and log lines")
+    parser.add_argument('--amp', action='store_true', help="mixed precision, float16 with gradient scaling on GPU and bfloat16 on CPU")
+    parser.add_argument('--channels_last', action='store_true', help="run the backbone in channels-last memory format")
+    parser.add_argument('--image_cache', type=int, default=0, help="MB of decoded scene images cached by each data loading worker for svt|synthtext")
+    parser.add_argument('--group_images', action='store_true', help="sample the words of one svt|synthtext scene image together, so they hit the image cache")
+    parser.add_argument('--prefetch', type=int, default=2, help="batches loaded ahead by each data loading worker")
+    parser.add_argument('--checkpoint_interval', type=int, default=1000, help="training steps between two full-state checkpoints, 0 to only save at the end of an epoch")
+    parser.add_argument('--resume', action='store_true', help="resume from checkpoint.pth in the output folder, with the optimizer, schedule, data order and random state")
+    parser.add_argument('--backend', type=str, default='', help="process group backend when launched with torchrun - nccl|gloo, default nccl on GPU and gloo on CPU")
     
     opt = parser.parse_args()
     print(opt)
     
-    opt.manualSeed = random.randint(1, 10000)  # fix seed
-    print("Random Seed:", opt.manualSeed)
-    random.seed(opt.manualSeed)
-    torch.manual_seed(opt.manualSeed)
-    
     # turn on GPU for models:
-    if opt.gpu == False:
+    distributed = is_distributed_launch()
+    if distributed:
+        rank, world_size, device = init_distributed(opt.gpu, opt.backend)
+        print("Distributed training - rank {} of {} on {}".format(rank, world_size, device))
+    elif opt.gpu == False:
         device = torch.device("cpu")
         print("CPU being used!")
     else:
@@ -56,6 +77,23 @@ if __name__ == '__main__':
         else:
             device = torch.device("cpu")
             print("CPU being used!")
+    if not distributed:
+        rank, world_size = 0, 1
+    main_process = rank == 0 # only rank 0 logs and writes checkpoints
+
+    checkpoint_path = os.path.join(opt.output, 'checkpoint.pth')
+    resume_state = None
+    if opt.resume:
+        if os.path.exists(checkpoint_path):
+            resume_state = torch.load(checkpoint_path, map_location=lambda storage, loc: storage, weights_only=False)
+        else:
+            print("No checkpoint found at {}, train from scratch".format(checkpoint_path))
+
+    # the seed also fixes the data order of every epoch, so it is shared by all processes and kept by checkpoints
+    opt.manualSeed = resume_state['seed'] if resume_state is not None else broadcast_value(random.randint(1, 10000))
+    print("Random Seed:", opt.manualSeed)
+    random.seed(opt.manualSeed + rank)
+    torch.manual_seed(opt.manualSeed + rank)
     
     # set training parameters
     batch_size = opt.batch
@@ -79,88 +117,126 @@ if __name__ == '__main__':
     output_path = opt.output
     trained_model_path = opt.model
     eval_metric = opt.metric
+    beam_width = opt.beam
+    length_penalty = opt.length_penalty
+    share_weights = opt.share_weights
+    compact = opt.compact
+    stop_on_pad = opt.stop_on_pad
+    bucket = opt.bucket
+    amp = opt.amp
+    memory_format = torch.channels_last if opt.channels_last else torch.contiguous_format
+    cache_bytes = opt.image_cache * 2**20
     
     # create dataset
     print("Create dataset......")
-    if dataset_type == 'svt': # street view text dataset
-        img_path = os.path.join(dataset_path, 'img')
-        train_xml_path = os.path.join(dataset_path, 'train.xml')
-        test_xml_path = os.path.join(dataset_path, 'test.xml')
-        train_dataset = dataset.svt_dataset_builder(Height, Width, seq_len, img_path, train_xml_path)
-        test_dataset = dataset.svt_dataset_builder(Height, Width, seq_len, img_path, test_xml_path)
-    elif dataset_type == 'iiit5k': # IIIT5k dataset
-        train_img_path = os.path.join(dataset_path, 'train')
-        test_img_path = os.path.join(dataset_path, 'test')
-        train_annotation_path = os.path.join(dataset_path, 'traindata.mat')
-        test_annotation_path = os.path.join(dataset_path, 'testdata.mat')
-        train_dataset = dataset.iiit5k_dataset_builder(Height, Width, seq_len, train_img_path, train_annotation_path)
-        test_dataset = dataset.iiit5k_dataset_builder(Height, Width, seq_len, test_img_path, test_annotation_path)
-    elif dataset_type == 'iiit5k2': # IIIT5k dataset
-        train_img_path = os.path.join(dataset_path, 'train')
-        test_img_path = os.path.join(dataset_path, 'test')
-        train_annotation_path = os.path.join(dataset_path, 'traindata.mat')
-        test_annotation_path = os.path.join(dataset_path, 'testdata.mat')
-        train_dataset = dataset.iiit5k_dataset_builder2(Height, Width, seq_len, train_img_path, train_annotation_path,train=True)
-        test_dataset = dataset.iiit5k_dataset_builder2(Height, Width, seq_len, test_img_path, test_annotation_path,train=False)
-    elif dataset_type == 'syn90k': # Syn90K dataset
-        train_img_path = os.path.join(dataset_path, 'train')
-        test_img_path = os.path.join(dataset_path, 'test')
-        train_dataset = dataset.syn90k_dataset_builder(Height, Width, seq_len, train_img_path)
-        test_dataset = dataset.syn90k_dataset_builder(Height, Width, seq_len, test_img_path)
-    elif dataset_type == 'synthtext': # SynthText dataset
-        train_img_path = os.path.join(dataset_path, 'train')
-        test_img_path = os.path.join(dataset_path, 'test')
-        annotation_path = os.path.join(dataset_path, 'gt.mat')
-        train_dataset = dataset.synthtext_dataset_builder(Height, Width, seq_len, train_img_path, annotation_path)
-        test_dataset = dataset.synthtext_dataset_builder(Height, Width, seq_len, test_img_path, annotation_path)
-    else:
+    if dataset_type not in dataset.dataset_types:
         print("Not supported yet!")
         exit(1)
+    train_dataset, test_dataset = dataset.build_dataset(dataset_type, dataset_path, Height, Width, seq_len, cache_bytes, variable_width=bucket)
     
-    # make dataloader
-    train_dataloader = torch.utils.data.DataLoader(
-                    train_dataset,
-                    batch_size=batch_size,
-                    shuffle=True,
-                    num_workers=int(worker))
-        
-    test_dataloader = torch.utils.data.DataLoader(
-                    test_dataset,
-                    batch_size=batch_size,
-                    shuffle=True,
-                    num_workers=int(worker))
+    # make dataloader, workers are kept alive across epochs and batches are pinned for CUDA
+    options = loader_options(int(worker), device, opt.prefetch)
+    if opt.group_images and not hasattr(train_dataset, 'image_ids'):
+        print("--group_images is only supported with --dataset_type svt|synthtext!")
+        exit(1)
+    if bucket:
+        if dataset_type != 'iiit5k2':
+            print("--bucket is only supported with --dataset_type iiit5k2!")
+            exit(1)
+        if distributed:
+            print("--bucket is not supported with distributed training yet!")
+            exit(1)
+        train_widths = train_dataset.widths()
+        test_widths = test_dataset.widths()
+        train_sampler = dataset.skip_sampler(dataset.bucket_batch_sampler(train_widths, batch_size, lengths=train_dataset.label_lengths() if opt.bucket_length else None, seed=opt.manualSeed))
+        test_sampler = dataset.bucket_batch_sampler(test_widths, batch_size, shuffle=False)
+        print("Train padding waste - fixed width: {:.3f} bucketed: {:.3f}".format(
+            1.0 - sum(train_widths) / (Width * len(train_widths)), dataset.padding_waste(train_widths, train_sampler)))
+        train_dataloader = torch.utils.data.DataLoader(
+                        train_dataset,
+                        batch_sampler=train_sampler,
+                        collate_fn=dataset.bucket_collate,
+                        **options)
+
+        test_dataloader = torch.utils.data.DataLoader(
+                        test_dataset,
+                        batch_sampler=test_sampler,
+                        collate_fn=dataset.bucket_collate,
+                        **options)
+    elif distributed:
+        # every process reads its own shard, --batch is the batch size per process
+        if opt.group_images:
+            train_sampler = dataset.skip_sampler(dataset.image_group_sampler(train_dataset.image_ids(), seed=opt.manualSeed, num_replicas=world_size, rank=rank))
+        else:
+            train_sampler = dataset.skip_sampler(torch.utils.data.distributed.DistributedSampler(train_dataset, shuffle=True, seed=opt.manualSeed))
+        test_sampler = dataset.shard_sampler(test_dataset, num_replicas=world_size, rank=rank) # unpadded, every test sample is counted once
+        train_dataloader = torch.utils.data.DataLoader(
+                        train_dataset,
+                        batch_size=batch_size,
+                        sampler=train_sampler,
+                        **options)
+
+        test_dataloader = torch.utils.data.DataLoader(
+                        test_dataset,
+                        batch_size=batch_size,
+                        sampler=test_sampler,
+                        **options)
+    else:
+        # a single replica DistributedSampler shuffles by seed and epoch, so an interrupted epoch can be resumed
+        if opt.group_images:
+            train_sampler = dataset.skip_sampler(dataset.image_group_sampler(train_dataset.image_ids(), seed=opt.manualSeed))
+        else:
+            train_sampler = dataset.skip_sampler(torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=1, rank=0, shuffle=True, seed=opt.manualSeed))
+        train_dataloader = torch.utils.data.DataLoader(
+                        train_dataset,
+                        batch_size=batch_size,
+                        sampler=train_sampler,
+                        **options)
+
+        test_dataloader = torch.utils.data.DataLoader(
+                        test_dataset,
+                        batch_size=batch_size,
+                        shuffle=True,
+                        **options)
+
+    # the next batch is copied to the device and normalized while the current step computes
+    train_loader = prefetch_loader(train_dataloader, device, memory_format)
+    test_loader = prefetch_loader(test_dataloader, device, memory_format)
 
     print("Length of train dataset is:", len(train_dataset))
     print("Length of test dataset is:", len(test_dataset))
     print("Number of output classes is:", train_dataset.output_classes)
 
     # make model output folder
-    try:
-        os.makedirs(output_path)
-    except OSError:
-        pass
+    if main_process:
+        try:
+            os.makedirs(output_path)
+        except OSError:
+            pass
 
     # create model
     print("Create model......")
-    model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, device)
+    model = sar(Channel, feature_height, feature_width, embedding_dim, output_classes, hidden_units, layers, keep_prob, seq_len, device, beam_width, length_penalty, share_weights, compact, stop_on_pad)
+    if opt.channels_last:
+        model = channels_last(model)
 
     if trained_model_path != '':
-        if torch.cuda.is_available() == True and opt.gpu == True:
-            model.load_state_dict(torch.load(trained_model_path, map_location=lambda storage, loc: storage), strict=False)
-            model = torch.nn.DataParallel(model).to(device)
-        else:
-            model.load_state_dict(torch.load(trained_model_path, map_location=lambda storage, loc: storage), strict=False)
-    else:
-        if torch.cuda.is_available() == True and opt.gpu == True:
-            model = torch.nn.DataParallel(model).to(device)
-        else:
-            model = model.to(device)
+        model.load_state_dict(torch.load(trained_model_path, map_location=lambda storage, loc: storage), strict=False)
+    model = model.to(device)
+    if distributed:
+        # the classifier of the MobileNetV2 backbone takes no part in the forward pass
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None, find_unused_parameters=True)
+    elif device.type == 'cuda':
+        model = torch.nn.DataParallel(model)
+    model_to_save = model.module if hasattr(model, 'module') else model
+    # DDP broadcasts the BatchNorm buffers in every forward, a collective call that ranks with an empty or shorter
+    # test shard would skip, so validation runs on the unwrapped model
+    eval_model = model_to_save if distributed else model
 
     optimizer = optim.Adam(model.parameters(), lr=0.001)
     lmbda = lambda epoch: 0.9**(epoch // 10) if epoch < 90 else 10**(-2)
     scheduler = optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lmbda)
-
-    num_batch = math.ceil(len(train_dataset) / batch_size)
+    scaler = grad_scaler(device, amp)
 
     # train, evaluate, and save model
     print("Training starts......")
@@ -172,34 +248,91 @@ if __name__ == '__main__':
         print("Wrong --metric argument, set it to default")
         eval_metric = 'accuracy'
         best_acc = float('-inf')
+    start_epoch = 0
+    start_step = 0
+    global_step = 0
+    if resume_state is not None:
+        model_to_save.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        scaler.load_state_dict(resume_state['scaler'])
+        start_epoch = resume_state['epoch']
+        start_step = resume_state['step']
+        global_step = resume_state.get('global_step', 0) # step counter of the log, missing in older checkpoints
+        best_acc = resume_state['best_acc']
+        if len(resume_state['rng']) == world_size:
+            set_rng_state(resume_state['rng'][rank]) # every process continues its own random streams
+        else:
+            print("Checkpoint saved with {} processes, keeping the random number generators seeded with seed + rank".format(len(resume_state['rng'])))
+        print("Resume from epoch {} step {}".format(start_epoch, start_step))
+        resume_state = None
+    logger = train_logger(os.path.join(output_path, 'train_log.jsonl'), char2id, eval_metric, opt.log_interval, global_step) if main_process else None
+    writer = checkpoint_writer(checkpoint_path) if main_process else None
+
+    def save_checkpoint(epoch, step):
+        '''
+        epoch: epoch to resume at
+        step: training steps of that epoch already done
+        Called by every process, the random number generator states of all ranks are stored.
+        '''
+        rng = gather_values(rng_state()) # [world_size]
+        if not main_process:
+            return
+        writer.save({
+            'model': model_to_save.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'scaler': scaler.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'global_step': logger.step,
+            'best_acc': best_acc,
+            'seed': opt.manualSeed,
+            'rng': rng,
+        })
 
-    for epoch in range(epochs):
-        M_list = []
-        for i, data in enumerate(train_dataloader):
+    for epoch in range(start_epoch, epochs):
+        epoch_start = time.time()
+        epoch_samples = 0
+        train_sampler.set_epoch(epoch) # a different shuffle at every epoch, the same on all processes
+        step = start_step if epoch == start_epoch else 0
+        if step > 0:
+            train_sampler.skip(step if bucket else step * batch_size) # the batch sampler counts batches
+        if main_process:
+            logger.start_epoch()
+        for i, data in enumerate(train_loader):
+            data_time = train_loader.data_time # seconds waited for this batch
             x = data[0] # [batch_size, Channel, Height, Width]
-            y = data[1] # [batch_size, seq_len, output_classes]
-            x, y = x.to(device), y.to(device)
+            y = data[1] # [batch_size, seq_len]
+            width = data[2] if len(data) > 2 else None # [batch_size] valid image widths of padded datasets
             #print(x.shape, y.shape)
             optimizer.zero_grad()
             model = model.train()
-            predict, _, _, _ = model(x, y)
-            target = y.max(2)[1] # [batch_size, seq_len]
+            with autocast(device, amp):
+                predict, _, _, _ = model(x, y, width)
+            predict = predict.float()
+            target = y # [batch_size, seq_len]
             #print("Prediction size is:", predict.shape)
             #print("Attention weight size is:", att_weights.shape)
             predict_reshape = predict.permute(0,2,1) # [batch_size, output_classes, seq_len]
             loss = F.nll_loss(predict_reshape, target)
-            loss.backward()
-            optimizer.step()
-            # prediction evaluation
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            # prediction evaluation, accumulated on device and synchronized every log_interval steps
             pred_choice = predict.max(2)[1] # [batch_size, seq_len]
-            metric, metric_list, predict_words, labeled_words = performance_evaluate(pred_choice.detach().cpu().numpy(), target.detach().cpu().numpy(), voc, char2id, id2char, eval_metric)
-            M_list += metric_list
-            print('[Epoch %d: %d/%d] train loss: %f accuracy: %f' % (epoch, i, num_batch, loss.item(), metric))
-            #print("predict prob:", predict[0][0])
-            #print("predict words:", predict_words[0])
-            #print("labeled words:", labeled_words[0])
-        train_acc = float(sum(M_list)/len(M_list))
-        print("Epoch {} average train accuracy: {}".format(epoch, train_acc))
+            if main_process:
+                logger.update(epoch, loss, pred_choice, target, data_time)
+            epoch_samples += target.size(0)
+            step += 1
+            if opt.checkpoint_interval > 0 and step % opt.checkpoint_interval == 0:
+                save_checkpoint(epoch, step)
+        if main_process:
+            train_acc = logger.end_epoch(epoch)
+            print("Epoch {} average train accuracy: {}".format(epoch, train_acc))
+            print("Epoch {} train speed: {:.1f} images/sec".format(epoch, epoch_samples*world_size/(time.time()-epoch_start)))
+            if cache_bytes > 0 and hasattr(train_dataset, 'cache'):
+                print("Epoch {} image cache: {}".format(epoch, train_dataset.cache.stats()))
 
         scheduler.step()
 
@@ -208,22 +341,28 @@ if __name__ == '__main__':
         with torch.set_grad_enabled(False):
             M_list = []
             time_list = []
-            for i, data in enumerate(test_dataloader):
+            for i, data in enumerate(test_loader):
                 x = data[0] # [batch_size, Channel, Height, Width]
-                y = data[1] # [batch_size, seq_len, output_classes]
-                x, y = x.to(device), y.to(device)
-                model = model.eval()
+                y = data[1] # [batch_size, seq_len]
+                width = data[2] if len(data) > 2 else None # [batch_size] valid image widths of padded datasets
+                eval_model.eval()
                 start_time = time.time()
-                predict, _, _, _ = model(x, y)
+                with autocast(device, amp):
+                    predict, _, _, _ = eval_model(x, y, width)
                 # prediction evaluation
                 pred_choice = predict.max(2)[1] # [batch_size, seq_len]
-                target = y.max(2)[1] # [batch_size, seq_len]
+                target = y # [batch_size, seq_len]
                 metric, metric_list, predict_words, labeled_words = performance_evaluate(pred_choice.detach().cpu().numpy(), target.detach().cpu().numpy(), voc, char2id, id2char, eval_metric)
                 time_end = time.time()
                 M_list += metric_list
                 time_list.append(time_end-start_time)
-            test_acc = float(sum(M_list)/len(M_list))
-            time_const = float(sum(time_list)/len(time_list))
+            # sum the metric over the test shards of all processes
+            metric_sum, metric_count = all_reduce_sum([float(sum(M_list)), len(M_list)], device)
+            test_acc = metric_sum/metric_count
+            time_const = float(sum(time_list)/max(len(time_list), 1)) # a shard can be empty on small test sets
+            if not main_process:
+                save_checkpoint(epoch + 1, 0)
+                continue
             #print("Test predict words:", predict_words[0])
             #print("Test labeled words:", labeled_words[0])
             print("Epoch {} average test accuracy: {}".format(epoch, test_acc))
@@ -234,16 +373,15 @@ if __name__ == '__main__':
                 if test_acc >= best_acc:
                     print("Save current best model with accuracy:", test_acc)
                     best_acc = test_acc
-                    if torch.cuda.is_available() == True and opt.gpu == True:
-                        torch.save(model.module.state_dict(), '%s/model_best.pth' % (output_path))
-                    else:
-                        torch.save(model.state_dict(), '%s/model_best.pth' % (output_path))
+                    torch.save(model_to_save.state_dict(), '%s/model_best.pth' % (output_path))
             elif eval_metric == 'editdistance':
                 if test_acc <= best_acc:
                     print("Save current best model with accuracy:", test_acc)
                     best_acc = test_acc
-                    if torch.cuda.is_available() == True and opt.gpu == True:
-                        torch.save(model.module.state_dict(), '%s/model_best.pth' % (output_path))
-                    else:
-                        torch.save(model.state_dict(), '%s/model_best.pth' % (output_path))
-    print("Best test accuracy is:", best_acc)
\ No newline at end of file
+                    torch.save(model_to_save.state_dict(), '%s/model_best.pth' % (output_path))
+            save_checkpoint(epoch + 1, 0)
+    if main_process:
+        print("Best test accuracy is:", best_acc)
+        logger.close()
+        writer.close()
+    cleanup()
@@ -33,6 +33,19 @@ def attention_map(predict_word, x, attention_weight):
 
     return heatmaps, overlaps
 
+def save_attention_map(path_prefix, predict_word, x, attention_weight):
+    '''
+    Render the attention maps of a word and write one overlayed png per character.
+    Input:
+    path_prefix: output path without extension, character t is written to path_prefix_t.png
+    predict_word: string of predicted word
+    x: tensor of original image [C, H, W] on CPU, channel in BGR order, normalized to [-1, 1]
+    attention_weight: tensor of attention weights [seq_len, 1, feature_H, feature_W] on CPU
+    '''
+    _, overlaps = attention_map(predict_word, x, attention_weight)
+    for t, img in enumerate(overlaps):
+        cv2.imwrite('{}_{}.png'.format(path_prefix, t), img)
+
 # unit test
 if __name__ == '__main__':
 
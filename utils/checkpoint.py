@@ -0,0 +1,161 @@
+'''
+This code is to provide checkpoint conversion functions and resumable training checkpoints.
+'''
+import os
+import re
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+def share_lstm_weights(state_dict, mode='average', step=1, prefix='decoder_model.'):
+    '''
+    Convert a state dict with one decoder LSTM cell per time step into the weight-shared decoder.
+    Input:
+    state_dict: state dict of sar (or of decoder with prefix='') with lstmcell1.{t}/lstmcell2.{t} entries
+    mode: 'average' to average the cells of all time steps, 'select' to keep the cell of one step
+    step: time step kept with mode='select'
+    prefix: key prefix of the decoder parameters
+    Output:
+    shared_dict: state dict with a single lstmcell1.0/lstmcell2.0 per layer
+    '''
+    pattern = re.compile('^' + re.escape(prefix) + r'(lstmcell[12])\.(\d+)\.(.+)$')
+    shared_dict = {}
+    per_step = {} # (layer, parameter name) -> {t: tensor}
+    for key, value in state_dict.items():
+        match = pattern.match(key)
+        if match is None:
+            shared_dict[key] = value
+            continue
+        layer, t, name = match.group(1), int(match.group(2)), match.group(3)
+        per_step.setdefault((layer, name), {})[t] = value
+
+    for (layer, name), tensors in per_step.items():
+        if mode == 'average':
+            value = torch.stack([tensors[t].float() for t in sorted(tensors)]).mean(0).to(tensors[0].dtype)
+        elif mode == 'select':
+            if step not in tensors:
+                raise ValueError("step {} not found for {}{}, available steps are 0..{}".format(step, prefix, layer, max(tensors)))
+            value = tensors[step].clone()
+        else:
+            raise ValueError("mode should be average|select, got {}".format(mode))
+        shared_dict['{}{}.0.{}'.format(prefix, layer, name)] = value
+
+    return shared_dict
+
+def snapshot(obj):
+    '''
+    obj: nested dicts, lists and tuples of tensors and python values, e.g. an optimizer state dict
+    Output: the same structure with every tensor copied to CPU, so training can keep updating the originals
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+def atomic_save(obj, path):
+    '''
+    Write obj with torch.save to a temporary file next to path and rename it over path, so an
+    interrupted save never leaves a truncated checkpoint behind.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def rng_state():
+    '''
+    Output: states of the python, numpy, torch and CUDA random number generators
+    '''
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+def set_rng_state(state):
+    '''
+    state: output of rng_state()
+    '''
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class checkpoint_writer(object):
+    def __init__(self, path, asynchronous=True):
+        '''
+        path: checkpoint file, replaced atomically at every save
+        asynchronous: write on a background thread, only the copy of the tensors to CPU blocks training
+        '''
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.future = None
+
+    def save(self, state):
+        '''
+        state: dict of state dicts and python values to save
+        Waits for the previous save before taking the snapshot, so at most one snapshot is held in memory.
+        '''
+        self.wait()
+        state = snapshot(state)
+        if self.executor is None:
+            atomic_save(state, self.path)
+        else:
+            self.future = self.executor.submit(atomic_save, state, self.path)
+
+    def wait(self):
+        '''
+        Block until the pending save is written, raising its error if it failed.
+        '''
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+# unit test
+if __name__ == '__main__':
+    import sys
+    sys.path.append("..")
+
+    from models.decoder import decoder
+
+    output_classes = 97
+    seq_len = 40
+
+    decoder_model = decoder(output_classes, 6, 20, 64, 64, seq_len)
+    shared_model = decoder(output_classes, 6, 20, 64, 64, seq_len, share_weights=True)
+
+    shared_dict = share_lstm_weights(decoder_model.state_dict(), 'average', prefix='')
+    shared_model.load_state_dict(shared_dict)
+    print("Average conversion loaded, parameters before/after:",
+          sum(p.numel() for p in decoder_model.parameters()), sum(p.numel() for p in shared_model.parameters()))
+
+    shared_dict = share_lstm_weights(decoder_model.state_dict(), 'select', step=1, prefix='')
+    shared_model.load_state_dict(shared_dict)
+    print("Select conversion matches step 1:", torch.equal(shared_model.lstmcell1[0].weight_ih, decoder_model.lstmcell1[1].weight_ih))
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        writer = checkpoint_writer(os.path.join(folder, 'checkpoint.pth'))
+        state = {'model': decoder_model.state_dict(), 'rng': rng_state(), 'epoch': 3, 'step': 10}
+        writer.save(state)
+        for p in decoder_model.parameters(): # training goes on while the snapshot is written
+            p.data.zero_()
+        writer.close()
+        loaded = torch.load(os.path.join(folder, 'checkpoint.pth'), weights_only=False)
+        print("Checkpoint keeps the weights before the update:", loaded['model']['linear2.weight'].abs().sum().item() > 0,
+              "epoch/step:", loaded['epoch'], loaded['step'])
+        set_rng_state(loaded['rng'])
+        print("Temporary file removed:", os.listdir(folder))
@@ -4,6 +4,7 @@ This code is to provide necessary utilization functions.
 import string
 import editdistance
 import numpy as np
+import torch
 
 def end_cut(indices, char2id, id2char):
     '''
@@ -20,6 +21,114 @@ def end_cut(indices, char2id, id2char):
             break
     return ''.join(cut_indices)
 
+def word_log_prob(predict, end_id):
+    '''
+    predict: log-probability tensor of [batch_size, seq_len, output_classes] from the decoder
+    end_id: index of the END token
+    Output: tensor of [batch_size] with the summed log-probability of the decoded tokens up to and including END
+    '''
+    best, choice = predict.max(2) # [batch_size, seq_len]
+    is_end = (choice == end_id).long()
+    after_end = (torch.cumsum(is_end, dim=1) - is_end) > 0 # steps strictly after the first END
+
+    return best.masked_fill(after_end, 0.0).sum(1)
+
+def compact_tokens(indices, char2id):
+    '''
+    indices: numpy array of [batch_size, seq_len] with index in output_classes
+    charid: char to id conversion
+    Output: numpy array of [batch_size, seq_len] holding, for every row, the ids that end_cut keeps (before the
+    first END, without UNK and PAD) moved to the front and -1 after them, and numpy array of [batch_size] with their count
+    '''
+    indices = np.asarray(indices)
+    batch_size, seq_len = indices.shape
+    is_end = indices == char2id['END']
+    end = np.where(is_end.any(1), is_end.argmax(1), seq_len) # first END position per row [batch_size]
+    valid = (np.arange(seq_len) < end[:,None]) & (indices != char2id['UNK']) & (indices != char2id['PAD'])
+    order = np.argsort(~valid, axis=1, kind='stable') # valid ids first, keeping their order
+    compact = np.take_along_axis(indices, order, axis=1)
+    lengths = valid.sum(1)
+    compact[np.arange(seq_len) >= lengths[:,None]] = -1
+
+    return compact, lengths
+
+def word_correct(pred_choice, target, char2id):
+    '''
+    Exact word match computed on the device of its inputs, same result as comparing the end_cut strings
+    pred_choice: predicted tensor of [batch_size, seq_len] with index in output_classes
+    target: true tensor of [batch_size, seq_len] with index in output_classes
+    charid: char to id conversion
+    Output: bool tensor of [batch_size]
+    '''
+    compact = []
+    for indices in (pred_choice, target):
+        seq_len = indices.size(1)
+        before_end = torch.cumsum((indices == char2id['END']).int(), dim=1) == 0
+        valid = before_end & (indices != char2id['UNK']) & (indices != char2id['PAD'])
+        order = torch.sort((~valid).int(), dim=1, stable=True)[1] # valid ids first, keeping their order
+        ids = torch.gather(indices, 1, order)
+        lengths = valid.sum(1, keepdim=True)
+        compact.append(ids.masked_fill(torch.arange(seq_len, device=indices.device) >= lengths, -1))
+
+    return (compact[0] == compact[1]).all(1)
+
+def batch_edit_distance(a, a_len, b, b_len):
+    '''
+    Levenshtein distance of every row pair, with one vectorized dynamic programming row update per token of a
+    a: numpy array of [batch_size, La] of token ids
+    a_len: numpy array of [batch_size] with the number of valid tokens at the front of every row of a
+    b: numpy array of [batch_size, Lb] of token ids
+    b_len: numpy array of [batch_size] with the number of valid tokens at the front of every row of b
+    Output: numpy array of [batch_size] of edit distances
+    '''
+    batch_size, Lb = b.shape
+    rows = np.arange(batch_size)
+    j = np.arange(Lb+1)
+    prev = np.tile(j, (batch_size, 1)) # distances from the empty prefix of a [batch_size, Lb+1]
+    result = prev[rows, b_len].copy()
+    # invalid slots of b never match, so they do not change distances up to b_len
+    b = np.where(j[1:] <= b_len[:,None], b, -2)
+    for i in range(1, int(a_len.max(initial=0))+1):
+        cost = (a[:,i-1:i] != b).astype(np.int64) # substitution cost [batch_size, Lb]
+        cur = np.empty_like(prev)
+        cur[:,0] = i
+        cur[:,1:] = np.minimum(prev[:,1:] + 1, prev[:,:-1] + cost) # deletion or substitution
+        cur = np.minimum.accumulate(cur - j, axis=1) + j # insertions along the row
+        done = a_len == i
+        result[done] = cur[done, b_len[done]]
+        prev = cur
+
+    return result
+
+class lazy_words(object):
+    def __init__(self, indices, char2id, id2char):
+        '''
+        List-like view of the words of a batch, a word is only decoded by end_cut when it is accessed
+        indices: numpy array of [batch_size, seq_len] with index in output_classes
+        charid: char to id conversion
+        id2char: id to char conversion
+        '''
+        self.indices = indices
+        self.char2id = char2id
+        self.id2char = id2char
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return end_cut(self.indices[index], self.char2id, self.id2char)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
 def performance_evaluate(pred_choice, target, voc, char2id, id2char, metrics_type):
     '''
     pred_choice: predicted numpy array of [batch_size, seq_len] with index in output_classes
@@ -28,24 +137,21 @@ def performance_evaluate(pred_choice, target, voc, char2id, id2char, metrics_typ
     charid: char to id conversion
     id2char: id to char conversion
     metrics_type: evaluation metric name
+    The metrics are computed on token ids without building strings, the returned predicted and labeled
+    words are lazy_words that only decode a word when it is accessed.
     '''
-    batch_size = target.shape[0]
-    predicts = []
-    labels = []
-    for batch in range(batch_size):
-        predict_indices = pred_choice[batch]
-        tareget_indices = target[batch]
-
-        predicts.append(end_cut(predict_indices, char2id, id2char))
-        labels.append(end_cut(tareget_indices, char2id, id2char))
+    predict_ids, predict_len = compact_tokens(pred_choice, char2id)
+    target_ids, target_len = compact_tokens(target, char2id)
+    predicts = lazy_words(pred_choice, char2id, id2char)
+    labels = lazy_words(target, char2id, id2char)
 
     if metrics_type == 'accuracy':
-        acc_list = [(pred == tar) for pred, tar in zip(predicts, labels)]
+        acc_list = (predict_ids == target_ids).all(1).tolist()
         accuracy = 1.0 * sum(acc_list) / len(acc_list)
 
         return accuracy, acc_list, predicts, labels
     elif metrics_type == 'editdistance':
-        ed_list = [editdistance.eval(pred, targ) for pred, targ in zip(predicts, labels)]
+        ed_list = batch_edit_distance(predict_ids, predict_len, target_ids, target_len).tolist()
         eds = 1.0 * sum(ed_list) / len(ed_list)
 
         return eds, ed_list, predicts, labels
@@ -91,4 +197,13 @@ if __name__ == '__main__':
     print("Edit distance:", metric)
     print("Edit distance list:", metric_list)
     print("Predicted words:", predicts)
-    print("Labeled words:", labels)
\ No newline at end of file
+    print("Labeled words:", labels)
+
+    pred_choice = np.random.choice([0, 1, 2, char2id['END'], char2id['PAD'], char2id['UNK']], (256, seq_len))
+    target = np.random.choice([0, 1, 2, char2id['END'], char2id['PAD']], (256, seq_len))
+    predicts = [end_cut(p, char2id, id2char) for p in pred_choice]
+    labels = [end_cut(t, char2id, id2char) for t in target]
+    _, acc_list, _, _ = performance_evaluate(pred_choice, target, voc, char2id, id2char, 'accuracy')
+    _, ed_list, _, _ = performance_evaluate(pred_choice, target, voc, char2id, id2char, 'editdistance')
+    print("Vectorized accuracy matches strings:", acc_list == [p == t for p, t in zip(predicts, labels)])
+    print("Batched edit distance matches editdistance:", ed_list == [editdistance.eval(p, t) for p, t in zip(predicts, labels)])
\ No newline at end of file
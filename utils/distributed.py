@@ -0,0 +1,71 @@
+'''
+This code is to provide the process group helpers of distributed data-parallel training launched with torchrun.
+'''
+import os
+import torch
+import torch.distributed as dist
+
+def is_distributed_launch():
+    '''
+    Output: True if the process was started by torchrun, which sets WORLD_SIZE, RANK and LOCAL_RANK
+    '''
+    return 'WORLD_SIZE' in os.environ and 'LOCAL_RANK' in os.environ
+
+def init_distributed(gpu=False, backend=''):
+    '''
+    gpu: one GPU per process, selected by LOCAL_RANK
+    backend: process group backend, '' for nccl on GPU and gloo on CPU
+    Output: rank, world size, device of this process
+    '''
+    use_cuda = gpu and torch.cuda.is_available()
+    if backend == '':
+        backend = 'nccl' if use_cuda else 'gloo'
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), device
+
+def all_reduce_sum(values, device):
+    '''
+    values: list of python numbers of this process
+    device: device of this process, nccl needs CUDA tensors
+    Output: list of the sums over all processes, values unchanged if no process group is initialized
+    '''
+    if not (dist.is_available() and dist.is_initialized()):
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def broadcast_value(value):
+    '''
+    value: picklable python value of this process
+    Output: the value of rank 0, value unchanged if no process group is initialized
+    '''
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+    return values[0]
+
+def gather_values(value):
+    '''
+    value: picklable python value of this process
+    Output: list of the values of all processes indexed by rank, [value] if no process group is initialized
+    '''
+    if not (dist.is_available() and dist.is_initialized()):
+        return [value]
+    values = [None] * dist.get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+def cleanup():
+    '''
+    Destroy the process group if there is one.
+    '''
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,104 @@
+'''
+This code is to accumulate training metrics on device and write them as JSON lines.
+'''
+import json
+import time
+import torch
+from .dataproc import word_correct, compact_tokens, batch_edit_distance
+
+class train_logger(object):
+    def __init__(self, log_path, char2id, metrics_type='accuracy', interval=50, step=0):
+        '''
+        log_path: JSON lines file, appended to
+        char2id: char to id conversion
+        metrics_type: accuracy|editdistance
+        interval: steps between two host synchronizations and log lines
+        step: training steps already logged, restored from a checkpoint when resuming
+        Loss and accuracy sums stay on the device of the model until a log line is written. Edit distances
+        need the host, so the predictions of the interval are kept and evaluated when the line is written.
+        '''
+        self.log_file = open(log_path, 'a')
+        self.char2id = char2id
+        self.metrics_type = metrics_type
+        self.interval = interval
+        self.step = step
+        self.epoch_samples = 0
+        self.epoch_metric_sum = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.loss_sum = 0.0
+        self.metric_sum = 0.0
+        self.pending = []
+        self.samples = 0
+        self.data_time = 0.0
+        self.window_start = time.time()
+
+    def update(self, epoch, loss, pred_choice, target, data_time):
+        '''
+        epoch: current epoch
+        loss: mean loss tensor of the batch
+        pred_choice: predicted tensor of [batch_size, seq_len] with index in output_classes
+        target: true tensor of [batch_size, seq_len] with index in output_classes
+        data_time: seconds spent waiting for the batch
+        '''
+        batch_size = target.size(0)
+        self.loss_sum = self.loss_sum + loss.detach() * batch_size
+        if self.metrics_type == 'accuracy':
+            self.metric_sum = self.metric_sum + word_correct(pred_choice.detach(), target, self.char2id).sum()
+        else:
+            self.pending.append((pred_choice.detach(), target))
+        self.samples += batch_size
+        self.data_time += data_time
+        self.step += 1
+        if self.step % self.interval == 0:
+            self.flush(epoch)
+
+    def flush(self, epoch):
+        '''
+        Synchronize with the device and write one log line for the steps since the last one.
+        '''
+        if self.samples == 0:
+            return
+        if self.metrics_type == 'editdistance':
+            for pred_choice, target in self.pending:
+                predict_ids, predict_len = compact_tokens(pred_choice.cpu().numpy(), self.char2id)
+                target_ids, target_len = compact_tokens(target.cpu().numpy(), self.char2id)
+                self.metric_sum += float(batch_edit_distance(predict_ids, predict_len, target_ids, target_len).sum())
+        metric_sum = float(self.metric_sum)
+        elapsed = time.time() - self.window_start
+        record = {
+            'epoch': epoch,
+            'step': self.step,
+            'loss': float(self.loss_sum) / self.samples,
+            self.metrics_type: metric_sum / self.samples,
+            'samples_per_sec': self.samples / elapsed,
+            'data_wait': self.data_time, # seconds spent waiting for batches
+        }
+        line = json.dumps(record)
+        self.log_file.write(line + '\n')
+        self.log_file.flush()
+        print(line)
+        self.epoch_samples += self.samples
+        self.epoch_metric_sum += metric_sum
+        self._reset()
+
+    def start_epoch(self):
+        '''
+        Restart the timing window, so validation between epochs is not counted as training time.
+        '''
+        self.window_start = time.time()
+
+    def end_epoch(self, epoch):
+        '''
+        Flush the remaining steps of the epoch.
+        Output: average metric of the epoch
+        '''
+        self.flush(epoch)
+        metric = self.epoch_metric_sum / max(self.epoch_samples, 1)
+        self.epoch_samples = 0
+        self.epoch_metric_sum = 0.0
+        return metric
+
+    def close(self):
+        self.log_file.close()
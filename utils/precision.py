@@ -0,0 +1,29 @@
+'''
+This code is to provide mixed precision and memory format helpers for training.
+'''
+import torch
+
+def autocast(device, enabled=True):
+    '''
+    device: torch.device the model runs on
+    enabled: False gives a no-op context, i.e. float32
+    Output: autocast context with float16 on CUDA and bfloat16 on CPU
+    '''
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+def grad_scaler(device, enabled=True):
+    '''
+    device: torch.device the model runs on
+    enabled: use gradient scaling
+    Output: GradScaler, only active on CUDA since bfloat16 on CPU does not need loss scaling
+    '''
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+def channels_last(model):
+    '''
+    model: sar model, not wrapped in DataParallel
+    Output: model with its backbone convolutions in channels-last (NHWC) memory format
+    '''
+    model.backbone = model.backbone.to(memory_format=torch.channels_last)
+    return model
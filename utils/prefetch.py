@@ -0,0 +1,72 @@
+'''
+This code is to provide a data loader wrapper that prefetches batches to the device.
+'''
+import time
+import torch
+from dataset.dataset import normalize_batch
+
+def loader_options(worker, device, prefetch=2):
+    '''
+    worker: number of data loading workers
+    device: torch.device the batches are used on
+    prefetch: batches loaded ahead by each worker
+    Output: DataLoader keyword arguments keeping the workers alive across epochs and pinning batches for CUDA
+    '''
+    options = {'num_workers': worker, 'pin_memory': device.type == 'cuda'}
+    if worker > 0:
+        options['persistent_workers'] = True
+        options['prefetch_factor'] = prefetch
+    return options
+
+class prefetch_loader(object):
+    def __init__(self, dataloader, device, memory_format=torch.contiguous_format):
+        '''
+        dataloader: DataLoader of (uint8 images [batch, H, W, C], ...) batches
+        device: torch.device to move the batches to
+        memory_format: memory format of the normalized images
+        Yields the batches with the images normalized by normalize_batch and the other tensors on device.
+        On CUDA the copy and normalization of the next batch run on a side stream while the current step
+        computes. data_time holds the seconds spent waiting for the workers for the last yielded batch.
+        '''
+        self.dataloader = dataloader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.data_time = 0.0
+
+    def _to_device(self, data):
+        x = normalize_batch(data[0], self.device, self.memory_format)
+        rest = [item.to(self.device, non_blocking=True) if torch.is_tensor(item) else item for item in data[1:]]
+        return [x] + rest
+
+    def _preload(self, iterator):
+        '''
+        Output: next batch on device, or None at the end of the epoch, and the seconds waited for it
+        '''
+        start = time.time()
+        try:
+            data = next(iterator)
+        except StopIteration:
+            return None, time.time() - start
+        data_time = time.time() - start
+        if self.stream is None:
+            return self._to_device(data), data_time
+        with torch.cuda.stream(self.stream):
+            return self._to_device(data), data_time
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        data, data_time = self._preload(iterator)
+        while data is not None:
+            if self.stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                for item in data:
+                    if torch.is_tensor(item):
+                        item.record_stream(torch.cuda.current_stream(self.device)) # keep the memory until the step is done
+            self.data_time = data_time
+            next_data, data_time = self._preload(iterator) # copy of the next batch overlaps this step
+            yield data
+            data = next_data
+
+    def __len__(self):
+        return len(self.dataloader)
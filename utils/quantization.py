@@ -0,0 +1,57 @@
+'''
+This code is to provide int8 quantization of SAR for CPU inference.
+'''
+import io
+import torch
+from torch.ao.quantization import default_dynamic_qconfig, get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+def quantize_decoder(model):
+    '''
+    Dynamic int8 quantization of the decoder LSTM cells and output layer, weights are quantized ahead of time
+    and activations at run time.
+    Input:
+    model: sar in eval mode
+    Output: model with quantized decoder_model.lstmcell1, lstmcell2 and linear2
+    linear1 stays in float since decoder.embed reads its weight directly, and the attention convolutions
+    are not supported by dynamic quantization.
+    '''
+    qconfig_spec = {
+        'decoder_model.lstmcell1': default_dynamic_qconfig,
+        'decoder_model.lstmcell2': default_dynamic_qconfig,
+        'decoder_model.linear2': default_dynamic_qconfig,
+    }
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+def quantize_backbone(model, calibration_batches, backend='fbgemm'):
+    '''
+    Static post-training int8 quantization of the MobileNetV2 backbone with FX graph mode, which also folds
+    the batch norms and quantizes the residual additions.
+    Input:
+    model: sar in eval mode with an unfused backbone
+    calibration_batches: iterable of input images [batch, channel, height, width] normalized to [-1,1]
+    backend: quantized engine, fbgemm for x86 and qnnpack for ARM
+    Output: model with a quantized backbone that takes and returns float tensors
+    '''
+    torch.backends.quantized.engine = backend
+    example_inputs = None
+    prepared = None
+    with torch.no_grad():
+        for x in calibration_batches:
+            if prepared is None:
+                example_inputs = (x,)
+                prepared = prepare_fx(model.backbone, get_default_qconfig_mapping(backend), example_inputs)
+            prepared(x) # observe activation ranges
+    if prepared is None:
+        raise ValueError("calibration_batches is empty")
+    model.backbone = convert_fx(prepared)
+    return model
+
+def model_size(model):
+    '''
+    model: any module
+    Output: size in bytes of its serialized state dict
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
@@ -0,0 +1,337 @@
+'''
+This code is to serve a Recognizer over HTTP with dynamic micro-batching.
+'''
+import asyncio
+import json
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import cv2
+import torch
+from dataset.dataset import preprocess_image, normalize_batch
+
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64] # upper bounds of the batch size histogram
+QUANTILES = [0.5, 0.9, 0.99]
+MAX_BODY = 16 * 2**20 # bytes of an encoded image
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+class serving_metrics(object):
+    def __init__(self, window=1000):
+        '''
+        Counters of the server rendered in the Prometheus text format.
+        window: number of recent requests the latency quantiles are computed over
+        '''
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batch_buckets = [0] * len(BATCH_BUCKETS)
+        self.batch_count = 0
+        self.batch_sum = 0
+        self.latency = {name: deque(maxlen=window) for name in ['queue', 'compute', 'total']}
+        self.latency_sum = {name: 0.0 for name in self.latency}
+        self.latency_count = 0
+
+    def observe_batch(self, batch_size, queue_times, compute_time):
+        '''
+        batch_size: images in the batch
+        queue_times: seconds each image waited before the batch started
+        compute_time: seconds the batch took
+        '''
+        with self.lock:
+            for i, bound in enumerate(BATCH_BUCKETS):
+                if batch_size <= bound:
+                    self.batch_buckets[i] += 1
+                    break
+            self.batch_count += 1
+            self.batch_sum += batch_size
+            self.latency_count += len(queue_times)
+            for queue_time in queue_times:
+                for name, value in [('queue', queue_time), ('compute', compute_time), ('total', queue_time + compute_time)]:
+                    self.latency[name].append(value)
+                    self.latency_sum[name] += value
+
+    def observe_request(self, ok):
+        with self.lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+
+    def render(self, queue_depth):
+        '''
+        queue_depth: images waiting for a batch
+        Output: metrics in the Prometheus text exposition format
+        '''
+        with self.lock:
+            lines = [
+                '# TYPE sar_requests_total counter',
+                'sar_requests_total {}'.format(self.requests),
+                '# TYPE sar_request_errors_total counter',
+                'sar_request_errors_total {}'.format(self.errors),
+                '# TYPE sar_queue_depth gauge',
+                'sar_queue_depth {}'.format(queue_depth),
+                '# TYPE sar_batch_size histogram',
+            ]
+            cumulative = 0
+            for bound, count in zip(BATCH_BUCKETS, self.batch_buckets):
+                cumulative += count
+                lines.append('sar_batch_size_bucket{{le="{}"}} {}'.format(bound, cumulative))
+            lines.append('sar_batch_size_bucket{{le="+Inf"}} {}'.format(self.batch_count))
+            lines.append('sar_batch_size_sum {}'.format(self.batch_sum))
+            lines.append('sar_batch_size_count {}'.format(self.batch_count))
+            for name, values in self.latency.items():
+                metric = 'sar_{}_seconds'.format(name)
+                lines.append('# TYPE {} summary'.format(metric))
+                if len(values) > 0:
+                    for q, value in zip(QUANTILES, np.quantile(np.array(values), QUANTILES)):
+                        lines.append('{}{{quantile="{}"}} {:.6f}'.format(metric, q, value))
+                lines.append('{}_sum {:.6f}'.format(metric, self.latency_sum[name]))
+                lines.append('{}_count {}'.format(metric, self.latency_count))
+        return '\n'.join(lines) + '\n'
+
+class micro_batcher(object):
+    def __init__(self, recognizer, max_batch=32, max_wait=0.005, metrics=None):
+        '''
+        Queue of single images run in batches on a dedicated inference thread.
+        recognizer: Recognizer to run
+        max_batch: max images per batch
+        max_wait: max seconds the first image of a batch waits for more images
+        metrics: serving_metrics to update, or None
+        '''
+        self.recognizer = recognizer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='sar-inference', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Finish the queued images and stop the inference thread.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, image):
+        '''
+        image: uint8 tensor [height, width, C] from preprocess_image
+        Output: Future of (text, confidence, timing dict with queue_time, compute_time in seconds and batch_size)
+        '''
+        future = Future()
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[2] + self.max_wait
+            # images that queued up during the last batch are taken at once, otherwise wait until the deadline
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch):
+        start = time.perf_counter()
+        try:
+            x = normalize_batch(torch.stack([image for image, _, _ in batch]), self.recognizer.device)
+            predict, _ = self.recognizer.predict(x)
+            results = self.recognizer.decode(predict)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        end = time.perf_counter()
+        for (_, future, enqueued), (text, log_prob) in zip(batch, results):
+            timing = {'queue_time': start - enqueued, 'compute_time': end - start, 'batch_size': len(batch)}
+            future.set_result((text, math.exp(log_prob), timing))
+        if self.metrics is not None:
+            self.metrics.observe_batch(len(batch), [start - enqueued for _, _, enqueued in batch], end - start)
+
+class recognition_server(object):
+    def __init__(self, recognizer, max_batch=32, max_wait=0.005):
+        '''
+        HTTP/1.1 server with keep-alive on asyncio:
+        POST /recognize with an encoded image (jpg, png, ...) as body returns {"text": ..., "confidence": ...}
+        with the X-Queue-Time-Ms, X-Compute-Time-Ms and X-Batch-Size headers
+        GET /metrics returns the Prometheus text metrics
+        GET /health returns ok
+        recognizer: Recognizer to serve
+        max_batch: max images per batch
+        max_wait: max seconds the first image of a batch waits for more images
+        '''
+        self.recognizer = recognizer
+        self.metrics = serving_metrics()
+        self.batcher = micro_batcher(recognizer, max_batch, max_wait, self.metrics)
+
+    async def start(self, host='127.0.0.1', port=8000, unix_path=None):
+        '''
+        Start the inference thread and listen on host:port, or on the Unix socket unix_path.
+        Output: asyncio server
+        '''
+        self.batcher.start()
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self.handle, path=unix_path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def stop(self):
+        self.batcher.stop()
+
+    def _decode(self, body):
+        IMG = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if IMG is None:
+            raise ValueError("cannot decode the image")
+        return preprocess_image(IMG, self.recognizer.height, self.recognizer.width)
+
+    async def _recognize(self, body):
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(None, self._decode, body) # off the event loop
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}), {}
+        text, confidence, timing = await asyncio.wrap_future(self.batcher.submit(image))
+        headers = {
+            'X-Queue-Time-Ms': '{:.3f}'.format(timing['queue_time'] * 1000),
+            'X-Compute-Time-Ms': '{:.3f}'.format(timing['compute_time'] * 1000),
+            'X-Batch-Size': str(timing['batch_size']),
+        }
+        return 200, 'application/json', json.dumps({'text': text, 'confidence': confidence}), headers
+
+    async def _route(self, method, path, body):
+        if method == 'POST' and path == '/recognize':
+            return await self._recognize(body)
+        if method == 'GET' and path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', self.metrics.render(self.batcher.queue.qsize()), {}
+        if method == 'GET' and path == '/health':
+            return 200, 'text/plain', 'ok\n', {}
+        return 404, 'application/json', json.dumps({'error': 'not found'}), {}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_http(reader)
+                if request is None:
+                    break
+                (method, path, version), headers, body = request
+                if body is None:
+                    status, content_type, text, extra = 413, 'application/json', json.dumps({'error': 'body too large'}), {}
+                else:
+                    try:
+                        status, content_type, text, extra = await self._route(method, path, body)
+                    except Exception as e:
+                        status, content_type, text, extra = 500, 'application/json', json.dumps({'error': str(e)}), {}
+                if path == '/recognize':
+                    self.metrics.observe_request(status == 200)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close' and body is not None
+                payload = text.encode('utf-8')
+                lines = ['HTTP/1.1 {} {}'.format(status, STATUS[status]),
+                         'Content-Type: {}'.format(content_type),
+                         'Content-Length: {}'.format(len(payload)),
+                         'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+                lines += ['{}: {}'.format(key, value) for key, value in extra.items()]
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass # client went away or sent a malformed request
+        finally:
+            writer.close()
+
+async def read_http(reader):
+    '''
+    Read one HTTP/1.x message.
+    reader: asyncio StreamReader
+    Output: (start line fields, lower-case headers dict, body) or None at the end of the stream, the start line
+    fields are (method, path, version) for a request and (version, status, reason) for a response,
+    body is None if it is larger than MAX_BODY
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    start = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    if len(start) != 3:
+        raise ValueError("malformed start line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        return tuple(start), headers, None
+    body = await reader.readexactly(length) if length > 0 else b''
+    return tuple(start), headers, body
+
+async def post_image(host, port, image_bytes):
+    '''
+    Minimal client of recognition_server for local tests.
+    image_bytes: encoded image
+    Output: status code, lower-case headers dict, decoded JSON body
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    request = 'POST /recognize HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(host, len(image_bytes))
+    writer.write(request.encode('latin-1') + image_bytes)
+    await writer.drain()
+    (_, status, _), headers, body = await read_http(reader)
+    writer.close()
+    return int(status), headers, json.loads(body)
+
+# unit test
+if __name__ == '__main__':
+    '''
+    Need to run from the repository root:
+    python -m utils.serving
+    '''
+    import os
+    import tempfile
+    from dataset.dataset import dictionary_generator
+    from models.sar import sar
+    from models.recognizer import Recognizer
+
+    torch.manual_seed(0)
+    voc, _, _ = dictionary_generator()
+    with tempfile.TemporaryDirectory() as folder:
+        model_path = os.path.join(folder, 'model_best.pth')
+        torch.save(sar(3, 12, 8, 512, len(voc), 512, 2, 1.0, 40).state_dict(), model_path)
+        recognizer = Recognizer(model_path)
+    images = [cv2.imencode('.png', np.random.randint(0, 255, (32, 100, 3), dtype=np.uint8))[1].tobytes() for _ in range(16)]
+
+    async def main():
+        server = recognition_server(recognizer, max_batch=8, max_wait=0.02)
+        listener = await server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        responses = await asyncio.gather(*[post_image('127.0.0.1', port, image) for image in images])
+        print("Status codes:", [status for status, _, _ in responses])
+        print("Batch sizes:", [headers['x-batch-size'] for _, headers, _ in responses])
+        print("First result:", responses[0][2], "queue/compute ms:", responses[0][1]['x-queue-time-ms'], responses[0][1]['x-compute-time-ms'])
+        status, _, _ = await post_image('127.0.0.1', port, b'not an image')
+        print("Bad image status:", status)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n')
+        _, _, body = await read_http(reader)
+        writer.close()
+        print(body.decode('utf-8'))
+        listener.close()
+        await listener.wait_closed()
+        server.stop()
+
+    asyncio.run(main())